@@ -1,134 +1,343 @@
 import csv
+import glob
 import os
 import datetime
+import time
 
 FILE_AGENDA = "agenda_citas.csv"
+# Registro de cambios que se agregan al final (nunca se reescribe)
+FILE_EVENTOS = "agenda_citas_eventos.csv"
+# Solo un proceso compacta a la vez
+FILE_LOCK_COMPACTAR = FILE_EVENTOS + ".lock"
 
 # Horarios de trabajo (9am - 8pm)
 HORA_INICIO = 9
 HORA_FIN = 20
 
-def inicializar_agenda():
-    """Crea el archivo Excel/CSV si no existe"""
-    if not os.path.exists(FILE_AGENDA):
-        with open(FILE_AGENDA, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(["Fecha", "Hora", "Cliente", "Telefono", "Estado"])
+# Cantidad de eventos tras la cual se compacta el registro en el CSV principal
+COMPACTAR_CADA = 200
+# Un lock de compactación más viejo que esto quedó de un proceso que se cortó
+LOCK_VENCE_SEGUNDOS = 60
 
-def leer_todas_las_citas():
-    """Lee todas las citas del CSV y las devuelve como lista de diccionarios"""
-    citas = []
-    if not os.path.exists(FILE_AGENDA):
-        return citas
-        
+COLUMNAS = ["Fecha", "Hora", "Cliente", "Telefono", "Estado"]
+COLUMNAS_EVENTOS = ["Accion", "Id", "Fecha", "Hora", "Cliente", "Telefono"]
+# Última fila de la foto: hasta qué registro apartado incluye
+MARCA_COMPACTADO = "#compactado"
+
+
+class _IndiceAgenda:
+    """
+    Estado de la agenda en memoria.
+    - agenda_citas.csv es la foto compactada; cada fila es una cita (id = posición)
+    - agenda_citas_eventos.csv guarda los cambios posteriores:
+        agendar     -> nueva cita (toma el siguiente id)
+        reprogramar -> cambia Hora/Telefono de la cita Id
+        cancelar    -> pasa a Cancelado la cita Id
+    - Al compactar, el registro se aparta como agenda_citas_eventos.csv.<marca>
+      y se borra recién cuando la foto con esa marca está en su lugar; si
+      quedó alguno con marca mayor a la de la foto, se aplica al cargar.
+    - Solo se relee lo que cambió en disco (mtime/tamaño); si el registro
+      solo creció, se leen las líneas nuevas desde la última posición.
+    """
+
+    def __init__(self):
+        self.citas = []
+        self.por_fecha = {}
+        self._firma_agenda = None
+        self._posicion_eventos = 0
+        self._inodo_eventos = None
+        self._eventos = 0
+        self._marca = ""
+        # Bytes leídos de cada registro apartado en la última carga
+        self._leido_apartados = {}
+
+    def _cargar_todo(self, firma_agenda):
+        self.citas = []
+        self.por_fecha = {}
+        self._posicion_eventos = 0
+        self._eventos = 0
+        self._marca = ""
+        self._leido_apartados = {}
+        if firma_agenda is not None:
+            try:
+                with open(FILE_AGENDA, mode='r', encoding='utf-8') as file:
+                    for row in csv.DictReader(file):
+                        if row["Fecha"] == MARCA_COMPACTADO:
+                            self._marca = row["Hora"]
+                        else:
+                            self._agregar(row)
+            except Exception as e:
+                print(f"[ERROR LEYENDO AGENDA] {e}")
+        self._firma_agenda = firma_agenda
+
+        # Registros de una compactación que no llegó a reemplazar la foto
+        for marca, ruta in _apartados():
+            if marca > self._marca:
+                self._leido_apartados[ruta] = self._leer_eventos(ruta, 0)
+
+    def _agregar(self, cita):
+        self.citas.append(cita)
+        self.por_fecha.setdefault(cita["Fecha"], []).append(len(self.citas) - 1)
+
+    def _aplicar(self, evento):
+        accion = evento["Accion"]
+        if accion == "agendar":
+            self._agregar({
+                "Fecha": evento["Fecha"],
+                "Hora": evento["Hora"],
+                "Cliente": evento["Cliente"],
+                "Telefono": evento["Telefono"],
+                "Estado": "Confirmado",
+            })
+            return
+
+        try:
+            cita = self.citas[int(evento["Id"])]
+        except (ValueError, IndexError):
+            return  # Evento de una cita que aún no vemos (compactación en curso)
+        if accion == "reprogramar":
+            cita["Hora"] = evento["Hora"]
+            cita["Telefono"] = evento["Telefono"]
+        elif accion == "cancelar":
+            cita["Estado"] = "Cancelado"
+
+    def _leer_eventos(self, ruta, posicion):
+        """Aplica los eventos de `ruta` desde `posicion`; devuelve hasta dónde leyó"""
+        try:
+            with open(ruta, mode='r', newline='', encoding='utf-8') as file:
+                file.seek(posicion)
+                # Solo líneas completas (otro proceso puede estar escribiendo)
+                bloque = file.read()
+                completo = bloque[:bloque.rfind('\n') + 1]
+                for fila in csv.reader(completo.splitlines()):
+                    if fila and fila != COLUMNAS_EVENTOS:
+                        self._aplicar(dict(zip(COLUMNAS_EVENTOS, fila)))
+                        self._eventos += 1
+                return posicion + len(completo.encode('utf-8'))
+        except FileNotFoundError:
+            return posicion
+        except Exception as e:
+            print(f"[ERROR LEYENDO EVENTOS] {e}")
+            return posicion
+
+    def sincronizar(self):
+        """Pone el índice al día con los archivos"""
+        firma_agenda = _firma(FILE_AGENDA)
+        try:
+            info = os.stat(FILE_EVENTOS)
+            inodo_eventos, tamano_eventos = info.st_ino, info.st_size
+        except OSError:
+            inodo_eventos, tamano_eventos = None, 0
+
+        # Otro archivo de eventos (otro proceso compactó) o uno más corto: todo de nuevo
+        if (firma_agenda != self._firma_agenda or tamano_eventos < self._posicion_eventos
+                or (self._posicion_eventos and inodo_eventos != self._inodo_eventos)):
+            self._cargar_todo(firma_agenda)
+        self._inodo_eventos = inodo_eventos
+        if tamano_eventos == self._posicion_eventos:
+            return
+        self._posicion_eventos = self._leer_eventos(FILE_EVENTOS, self._posicion_eventos)
+
+    def registrar(self, accion, id_cita="", fecha="", hora="", cliente="", telefono=""):
+        """Agrega un evento al final del registro (O(1)) y lo aplica"""
+        with open(FILE_EVENTOS, mode='a', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerow([accion, id_cita, fecha, hora, cliente, telefono])
+        self.sincronizar()
+        if self._eventos >= COMPACTAR_CADA:
+            compactar_agenda()
+
+
+_indice = _IndiceAgenda()
+
+
+def _firma(ruta):
+    """(mtime, tamaño) de un archivo, o None si no existe"""
     try:
-        with open(FILE_AGENDA, mode='r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                citas.append(row)
-    except Exception as e:
-        print(f"[ERROR LEYENDO AGENDA] {e}")
-        
-    return citas
+        info = os.stat(ruta)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
 
-def guardar_todas_las_citas(citas):
-    """Sobrescribe el CSV con la lista actualizada"""
+
+def _apartados():
+    """[(marca, ruta)] de los registros apartados al compactar, del más viejo al más nuevo"""
+    prefijo = FILE_EVENTOS + "."
+    apartados = []
+    for ruta in glob.glob(glob.escape(prefijo) + "*"):
+        marca = ruta[len(prefijo):]
+        if marca.isdigit():
+            apartados.append((marca, ruta))
+    return sorted(apartados)
+
+
+def _tomar_lock_compactar():
+    """True si este proceso puede compactar (crea el lock de forma exclusiva)"""
+    for _ in range(2):
+        try:
+            os.close(os.open(FILE_LOCK_COMPACTAR, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            firma = _firma(FILE_LOCK_COMPACTAR)
+            if firma is None or time.time_ns() - firma[0] < LOCK_VENCE_SEGUNDOS * 1_000_000_000:
+                return False
+            try:
+                os.remove(FILE_LOCK_COMPACTAR)  # Lock abandonado
+            except OSError:
+                return False
+    return False
+
+
+def _reemplazar_foto(citas=None):
+    """
+    Escribe la foto y vacía el registro sin perder eventos:
+    1. Se aparta el registro (rename); los procesos siguen agregando a uno nuevo
+    2. Se escribe la foto con la marca del apartado y se reemplaza (os.replace)
+    3. Se borra el apartado
+    Si se corta antes de 2, la próxima carga aplica el apartado sobre la foto
+    anterior; si se corta después, la marca de la foto dice que ya está incluido.
+    citas=None compacta el estado actual (foto + todos los registros).
+    """
+    if not _tomar_lock_compactar():
+        return False
     try:
-        with open(FILE_AGENDA, mode='w', newline='', encoding='utf-8') as file:
+        _indice.sincronizar()
+        ultima = max([int(_indice._marca or 0)] + [int(marca) for marca, _ in _apartados()])
+        marca = f"{max(time.time_ns(), ultima + 1):020d}"
+        try:
+            os.replace(FILE_EVENTOS, f"{FILE_EVENTOS}.{marca}")
+        except FileNotFoundError:
+            pass  # Sin eventos desde la última compactación
+
+        leidos = {}
+        if citas is None:
+            # Incluye lo que otros procesos agregaron después del último sincronizar
+            _indice._cargar_todo(_firma(FILE_AGENDA))
+            citas = _indice.citas
+            leidos = _indice._leido_apartados
+
+        temporal = FILE_AGENDA + ".tmp"
+        with open(temporal, mode='w', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
-            writer.writerow(["Fecha", "Hora", "Cliente", "Telefono", "Estado"])
+            writer.writerow(COLUMNAS)
             for cita in citas:
                 writer.writerow([cita["Fecha"], cita["Hora"], cita["Cliente"], cita["Telefono"], cita["Estado"]])
+            writer.writerow([MARCA_COMPACTADO, marca, "", "", ""])
+        os.replace(temporal, FILE_AGENDA)
+
+        for marca_apartado, ruta in _apartados():
+            if marca_apartado > marca:
+                continue
+            # Un proceso que ya tenía abierto el registro pudo escribir después
+            # de leerlo: esas líneas pasan al registro nuevo
+            if ruta in leidos:
+                with open(ruta, mode='rb') as file:
+                    file.seek(leidos[ruta])
+                    cola = file.read()
+                if cola:
+                    with open(FILE_EVENTOS, mode='ab') as file:
+                        file.write(cola)
+            os.remove(ruta)
         return True
     except Exception as e:
         print(f"[ERROR GUARDANDO AGENDA] {e}")
         return False
+    finally:
+        try:
+            os.remove(FILE_LOCK_COMPACTAR)
+        except OSError:
+            pass
+
+
+def inicializar_agenda():
+    """Crea el archivo Excel/CSV si no existe"""
+    if not os.path.exists(FILE_AGENDA):
+        with open(FILE_AGENDA, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(COLUMNAS)
+
+def leer_todas_las_citas():
+    """Lee todas las citas del CSV y las devuelve como lista de diccionarios"""
+    _indice.sincronizar()
+    return [dict(c) for c in _indice.citas]
+
+def guardar_todas_las_citas(citas):
+    """Sobrescribe el CSV con la lista actualizada y vacía el registro de eventos"""
+    return _reemplazar_foto(citas)
+
+def compactar_agenda():
+    """Vuelca el estado actual al CSV principal y empieza un registro nuevo"""
+    guardado = _reemplazar_foto()
+    _indice.sincronizar()
+    return guardado
 
 def obtener_citas_dia(fecha_str):
     """Devuelve lista de horas ocupadas para una fecha"""
-    citas = leer_todas_las_citas()
-    ocupadas = []
-    for c in citas:
-        if c["Fecha"] == fecha_str and c["Estado"] == "Confirmado":
-            ocupadas.append(c["Hora"])
-    return ocupadas
+    _indice.sincronizar()
+    return [
+        _indice.citas[i]["Hora"]
+        for i in _indice.por_fecha.get(fecha_str, [])
+        if _indice.citas[i]["Estado"] == "Confirmado"
+    ]
 
 def obtener_horarios_disponibles(fecha_str):
     """Devuelve lista de horarios libres"""
     ocupadas = obtener_citas_dia(fecha_str)
     disponibles = []
-    
+
     for h in range(HORA_INICIO, HORA_FIN + 1):
         hora_formato = f"{h:02d}:00"
         if hora_formato not in ocupadas:
             disponibles.append(hora_formato)
-            
+
     return disponibles
 
 def agendar_cita(fecha, hora, cliente, telefono):
     """
-    Guarda la cita. 
+    Guarda la cita.
     Si el cliente YA tiene cita ese día, la actualiza (reprogramación).
     Si el horario está ocupado por OTRO, da error.
     """
     inicializar_agenda()
-    citas = leer_todas_las_citas()
-    
+    _indice.sincronizar()
+    del_dia = [(i, _indice.citas[i]) for i in _indice.por_fecha.get(fecha, [])]
+
     # 1. Verificar si el horario está ocupado por ALGUIEN MÁS
-    for c in citas:
-        if c["Fecha"] == fecha and c["Hora"] == hora and c["Estado"] == "Confirmado":
+    for _, c in del_dia:
+        if c["Hora"] == hora and c["Estado"] == "Confirmado":
             # Si es el mismo cliente, no pasa nada (es confirmar lo mismo)
             # Pero si es otro, error.
             if c["Cliente"].lower() != cliente.lower():
                 return False, f"El horario {hora} ya está ocupado."
 
     # 2. Buscar si el cliente ya tiene cita ESE DÍA para reprogramarla
-    cita_existente = None
     print(f"[DEBUG] Buscando cita previa para {cliente} en {fecha}...")
-    
-    for c in citas:
+
+    for i, c in del_dia:
         # Normalizamos nombres para comparar mejor (strip y lower)
-        nombre_csv = c["Cliente"].strip().lower()
-        nombre_nuevo = cliente.strip().lower()
-        
-        if c["Fecha"] == fecha and nombre_csv == nombre_nuevo and c["Estado"] == "Confirmado":
-            cita_existente = c
-            print(f"[DEBUG] ¡Encontrada! Hora actual: {c['Hora']}")
-            break
-    
-    if cita_existente:
-        # REPROGRAMAR: Cambiamos la hora de la cita existente
-        old_hora = cita_existente["Hora"]
-        cita_existente["Hora"] = hora
-        cita_existente["Telefono"] = telefono # Actualizar tel si cambió
-        guardar_todas_las_citas(citas)
-        print(f"[DEBUG] Actualizada a las {hora}")
-        return True, f"Reprogramado: De {old_hora} a {hora}"
-    else:
-        # NUEVA CITA
-        print(f"[DEBUG] No se encontró previa. Creando nueva.")
-        nueva_cita = {
-            "Fecha": fecha,
-            "Hora": hora,
-            "Cliente": cliente,
-            "Telefono": telefono,
-            "Estado": "Confirmado"
-        }
-        citas.append(nueva_cita)
-        guardar_todas_las_citas(citas)
-        return True, "Agendado correctamente"
+        if c["Cliente"].strip().lower() == cliente.strip().lower() and c["Estado"] == "Confirmado":
+            # REPROGRAMAR: Cambiamos la hora de la cita existente
+            old_hora = c["Hora"]
+            print(f"[DEBUG] ¡Encontrada! Hora actual: {old_hora}")
+            _indice.registrar("reprogramar", i, fecha, hora, c["Cliente"], telefono)
+            print(f"[DEBUG] Actualizada a las {hora}")
+            return True, f"Reprogramado: De {old_hora} a {hora}"
+
+    # NUEVA CITA
+    print(f"[DEBUG] No se encontró previa. Creando nueva.")
+    _indice.registrar("agendar", "", fecha, hora, cliente, telefono)
+    return True, "Agendado correctamente"
 
 def cancelar_cita(fecha, cliente):
     """Cancela citas de un cliente en una fecha"""
-    citas = leer_todas_las_citas()
-    encontrada = False
-    
-    for c in citas:
-        if c["Fecha"] == fecha and c["Cliente"].lower() == cliente.lower() and c["Estado"] == "Confirmado":
-            c["Estado"] = "Cancelado"
-            encontrada = True
-            
-    if encontrada:
-        guardar_todas_las_citas(citas)
+    _indice.sincronizar()
+    ids = [
+        i for i in _indice.por_fecha.get(fecha, [])
+        if _indice.citas[i]["Cliente"].lower() == cliente.lower() and _indice.citas[i]["Estado"] == "Confirmado"
+    ]
+
+    for i in ids:
+        _indice.registrar("cancelar", i)
+
+    if ids:
         return True, "Cita cancelada"
     return False, "No se encontró cita"
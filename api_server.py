@@ -7,18 +7,48 @@ API SERVER Y PANEL ADMIN PARA BOT DE BARBERÍA
 - Estadísticas en tiempo real
 """
 
-from flask import Flask, jsonify, request, render_template_string, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 from flask_cors import CORS
 import datetime
+import functools
 import json
 import os
+import queue
+import sys
+import threading
+import time
 
 # Importar base de datos
 from database import db
+import exportar
+import metricas
 
 app = Flask(__name__)
 CORS(app)  # Permitir CORS para futura app móvil
 
+# Modo producción (python api_server.py --produccion)
+PUERTO = 5000
+MAX_WORKERS = 8            # Procesos (gunicorn); SQLite tiene un solo escritor igual
+HILOS_POR_WORKER = 4       # Peticiones en paralelo por proceso
+KEEPALIVE_SEGUNDOS = 5
+APAGADO_SEGUNDOS = 30      # Tiempo para terminar las peticiones en curso al apagar
+
+# Eventos en vivo (/api/eventos)
+EVENTOS_INTERVALO_SEGUNDOS = 1.0   # Cada cuánto se revisan los contadores de cambios
+EVENTOS_LATIDO_SEGUNDOS = 15       # Comentario vacío para que proxies no corten la conexión
+EVENTOS_MAX_PENDIENTES = 100       # Eventos encolados por pestaña (si no lee, se descartan)
+EVENTOS_LOTE_MENSAJES = 100        # Mensajes nuevos por consulta al publicarlos
+# Cada pestaña conectada ocupa un hilo del servidor mientras está abierta:
+# estos hilos se suman a HILOS_POR_WORKER para que nunca dejen sin hilos a
+# las demás peticiones. Pasado el cupo se responde 503 y la pestaña consulta
+# /api/stats cada 30 s; cada conexión se cierra a los N segundos y el
+# navegador se reconecta (así se reparten entre los workers).
+EVENTOS_MAX_PESTANAS = 4           # Conexiones SSE simultáneas por proceso
+EVENTOS_DURACION_SEGUNDOS = 300
+
+# Página del panel: se reusa el HTML armado durante este tiempo sin consultar la base
+PANEL_TTL_SEGUNDOS = 2.0
+
 # ==================== PANEL WEB ADMIN HTML ====================
 ADMIN_HTML = '''
 <!DOCTYPE html>
@@ -402,18 +432,61 @@ ADMIN_HTML = '''
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify(config)
             }).then(r => r.json()).then(data => {
-                alert('✅ Configuración guardada');
+                alert(data.error ? '❌ ' + data.error : '✅ Configuración guardada');
             });
         });
         
-        // Actualizar estadísticas cada 30 segundos
-        setInterval(() => {
-            fetch('/api/stats').then(r => r.json()).then(data => {
-                document.getElementById('citas-hoy').textContent = data.citas_hoy;
-                document.getElementById('mensajes-hoy').textContent = data.mensajes_hoy;
-                document.getElementById('conv-activas').textContent = data.conversaciones_activas;
+        function mostrarStats(data) {
+            document.getElementById('citas-hoy').textContent = data.citas_hoy;
+            document.getElementById('mensajes-hoy').textContent = data.mensajes_hoy;
+            document.getElementById('conv-activas').textContent = data.conversaciones_activas;
+        }
+        
+        function mostrarCitasHoy(citas) {
+            const lista = document.getElementById('citas-hoy-list');
+            lista.replaceChildren();
+            if (!citas.length) {
+                const vacio = document.createElement('div');
+                vacio.className = 'empty-state';
+                vacio.textContent = 'No hay citas para hoy';
+                lista.appendChild(vacio);
+                return;
+            }
+            citas.forEach(cita => {
+                const item = document.createElement('div');
+                item.className = 'cita-item';
+                [['cita-hora', cita.hora], ['cita-cliente', cita.cliente_nombre], ['cita-estado', cita.estado]]
+                    .forEach(([clase, texto]) => {
+                        const span = document.createElement('span');
+                        span.className = clase;
+                        span.textContent = texto;
+                        item.appendChild(span);
+                    });
+                lista.appendChild(item);
             });
-        }, 30000);
+        }
+        
+        // Sin SSE: actualizar estadísticas cada 30 segundos
+        function consultarStats() {
+            setInterval(() => {
+                fetch('/api/stats').then(r => r.json()).then(mostrarStats);
+            }, 30000);
+        }
+        
+        // Cambios en vivo (reservas, cancelaciones, mensajes, estadísticas)
+        if (window.EventSource) {
+            const eventos = new EventSource('/api/eventos');
+            eventos.addEventListener('stats', e => mostrarStats(JSON.parse(e.data)));
+            eventos.addEventListener('citas_hoy', e => mostrarCitasHoy(JSON.parse(e.data)));
+            eventos.onerror = () => {
+                // 503 (sin cupo para más pestañas): el navegador no vuelve a intentar
+                if (eventos.readyState === EventSource.CLOSED) {
+                    consultarStats();
+                }
+            };
+        } else {
+            consultarStats();
+        }
     </script>
 </body>
 </html>
@@ -421,51 +494,288 @@ ADMIN_HTML = '''
 
 # ==================== RUTAS WEB ====================
 
+@functools.lru_cache(maxsize=8)
+def plantilla(fuente):
+    """Plantilla Jinja compilada una sola vez por texto fuente"""
+    return app.jinja_env.from_string(fuente)
+
+# HTML del panel ya armado (uno por proceso)
+_panel = {'html': None, 'fecha': None, 'versiones': None, 'vence': 0.0, 'generacion': 0}
+_panel_lock = threading.Lock()
+
+def invalidar_panel():
+    """Descarta el HTML cacheado; se llama después de cada escritura desde el panel"""
+    with _panel_lock:
+        _panel['html'] = None
+        _panel['generacion'] += 1
+
 @app.route('/')
 def index():
     """Página principal del panel admin"""
     hoy = datetime.date.today().isoformat()
     
-    return render_template_string(ADMIN_HTML,
-        nombre_negocio=db.get_config('nombre_negocio', 'Barbería'),
-        api_key=db.get_config('api_key', ''),
-        instrucciones=db.get_config('instrucciones', ''),
-        hora_inicio=db.get_config('hora_inicio', '9'),
-        hora_fin=db.get_config('hora_fin', '20'),
-        bot_activo_class='active' if db.get_config('bot_encendido', 'true') == 'true' else '',
-        stats=db.obtener_estadisticas(),
-        citas_hoy=db.obtener_citas_dia(hoy),
-        horarios_disponibles=db.obtener_horarios_disponibles(hoy),
+    with _panel_lock:
+        cache = dict(_panel)
+    if cache['html'] is not None and cache['fecha'] == hoy:
+        if time.monotonic() < cache['vence']:
+            return cache['html']
+        # Venció, pero si nada cambió en la base (ni el bot escribió) se sigue usando
+        if db.versiones_datos() == cache['versiones']:
+            with _panel_lock:
+                if _panel['generacion'] == cache['generacion']:
+                    _panel['vence'] = time.monotonic() + PANEL_TTL_SEGUNDOS
+            return cache['html']
+    
+    datos = db.obtener_panel(hoy)
+    config = datos['config']
+    html = plantilla(ADMIN_HTML).render(
+        nombre_negocio=config.get('nombre_negocio', 'Barbería'),
+        api_key=config.get('api_key', ''),
+        instrucciones=config.get('instrucciones', ''),
+        hora_inicio=config.get('hora_inicio', '9'),
+        hora_fin=config.get('hora_fin', '20'),
+        bot_activo_class='active' if config.get('bot_encendido', 'true') == 'true' else '',
+        stats=datos['stats'],
+        citas_hoy=datos['citas'],
+        horarios_disponibles=datos['horarios'],
         fecha_hoy=hoy
     )
+    
+    with _panel_lock:
+        # Si hubo una escritura mientras se armaba, no guardar un HTML ya viejo
+        if _panel['generacion'] == cache['generacion']:
+            _panel.update(html=html, fecha=hoy, versiones=datos['versiones'],
+                          vence=time.monotonic() + PANEL_TTL_SEGUNDOS)
+    return html
+
+# ==================== MÉTRICAS ====================
+
+HTTP_PETICIONES = metricas.Histograma('barberia_http_peticion_segundos', 'Duración de cada petición por ruta', ('ruta', 'metodo'))
+HTTP_RESPUESTAS = metricas.Contador('barberia_http_respuestas_total', 'Respuestas por ruta y código', ('ruta', 'metodo', 'estado'))
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+
+@app.after_request
+def registrar_medicion(respuesta):
+    """Latencia y código por ruta (la plantilla, no la URL: /api/horarios/<fecha>)"""
+    inicio = g.pop('inicio_peticion', None)
+    if inicio is not None:
+        ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+        HTTP_PETICIONES.observar(time.perf_counter() - inicio, ruta, request.method)
+        HTTP_RESPUESTAS.inc(ruta, request.method, respuesta.status_code)
+    return respuesta
+
+@app.route('/metrics')
+def metrics():
+    """Métricas del proceso en formato de texto de Prometheus"""
+    return Response(metricas.exposicion(), mimetype='text/plain; version=0.0.4')
+
+# ==================== CACHÉ HTTP ====================
+
+def con_etag(*tablas):
+    """
+    GET condicional: el ETag sale de los contadores de cambios de las
+    tablas que usa la ruta (y de la fecha, por los datos "de hoy").
+    Si coincide con If-None-Match se responde 304 sin consultar los datos.
+    """
+    def decorador(vista):
+        @functools.wraps(vista)
+        def envuelta(*args, **kwargs):
+            if request.method != 'GET':
+                return vista(*args, **kwargs)
+            versiones = db.versiones_datos()
+            etag = '-'.join(
+                [datetime.date.today().strftime('%Y%m%d')] +
+                [f"{tabla[0]}{versiones.get(tabla, 0)}" for tabla in tablas]
+            )
+            if request.if_none_match.contains(etag):
+                respuesta = app.response_class(status=304)
+            else:
+                respuesta = app.make_response(vista(*args, **kwargs))
+                if respuesta.status_code != 200:
+                    return respuesta
+            respuesta.set_etag(etag)
+            respuesta.headers['Cache-Control'] = 'no-cache'  # Siempre revalidar
+            return respuesta
+        return envuelta
+    return decorador
+
+# ==================== EVENTOS EN VIVO ====================
+
+class CanalEventos:
+    """
+    Reparte cambios a las pestañas abiertas del panel (Server-Sent Events).
+    - Un solo hilo por proceso revisa versiones_datos() cada pocos segundos;
+      solo si algo cambió consulta citas, mensajes y estadísticas
+    - Cada pestaña es una cola: conectar N pestañas no suma consultas
+    - Eventos: stats, citas_hoy, cita (agendada/cancelada/reprogramada), mensaje
+    """
+    
+    def __init__(self, intervalo=EVENTOS_INTERVALO_SEGUNDOS):
+        self.intervalo = intervalo
+        self._suscriptores = set()
+        self._lock = threading.Lock()
+        self._hilo = None
+        self._pid = None
+        # Estado visto en la última revisión (None = volver a tomar la base)
+        self._versiones = None
+        self._hoy = None
+        self._turnos = {}
+        self._ultimo_mensaje = 0
+        # Último stats/citas_hoy, para mandarlo apenas se conecta una pestaña
+        self._ultimos = {}
+    
+    def suscribir(self):
+        """Cola nueva para una pestaña (arranca el hilo si hace falta)"""
+        cola = queue.Queue(maxsize=EVENTOS_MAX_PENDIENTES)
+        with self._lock:
+            # Tras un fork (workers) el hilo del padre no existe en el hijo
+            if self._hilo is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._hilo = threading.Thread(target=self._bucle, name="eventos-panel", daemon=True)
+                self._hilo.start()
+            self._suscriptores.add(cola)
+            for evento, datos in self._ultimos.items():
+                cola.put_nowait((evento, datos))
+        return cola
+    
+    def desuscribir(self, cola):
+        with self._lock:
+            self._suscriptores.discard(cola)
+    
+    def _publicar(self, evento, datos):
+        with self._lock:
+            if evento in ('stats', 'citas_hoy'):
+                self._ultimos[evento] = datos
+            for cola in self._suscriptores:
+                try:
+                    cola.put_nowait((evento, datos))
+                except queue.Full:
+                    pass  # Pestaña que no lee: se pierde el evento, no frena a las demás
+    
+    def _bucle(self):
+        while True:
+            with self._lock:
+                activo = bool(self._suscriptores)
+            if activo:
+                try:
+                    self._revisar()
+                except Exception as e:
+                    print(f"[EVENTOS] Error revisando cambios: {e}")
+            else:
+                # Sin pestañas no se consulta nada; al volver se toma la base de nuevo
+                self._versiones = None
+            time.sleep(self.intervalo)
+    
+    def _revisar(self):
+        versiones = db.versiones_datos()
+        hoy = datetime.date.today().isoformat()
+        if versiones == self._versiones and hoy == self._hoy:
+            return
+        
+        # Primera revisión o cambio de día: tomar la base sin anunciar nada
+        inicial = self._versiones is None or hoy != self._hoy
+        anteriores = self._versiones or {}
+        self._versiones = versiones
+        self._hoy = hoy
+        
+        if inicial or versiones.get('citas') != anteriores.get('citas'):
+            turnos = {
+                cita['id']: cita for cita in db.obtener_todas_citas(hoy)
+                if cita['estado'] == 'Confirmado'
+            }
+            if not inicial:
+                for id_cita, cita in turnos.items():
+                    previa = self._turnos.get(id_cita)
+                    if previa is None:
+                        self._publicar('cita', dict(cita, accion='agendada'))
+                    elif (previa['fecha'], previa['hora']) != (cita['fecha'], cita['hora']):
+                        self._publicar('cita', dict(cita, accion='reprogramada'))
+                for id_cita in self._turnos.keys() - turnos.keys():
+                    self._publicar('cita', dict(self._turnos[id_cita], accion='cancelada'))
+            self._turnos = turnos
+            
+            citas_hoy = [cita for cita in turnos.values() if cita['fecha'] == hoy]
+            if citas_hoy != self._ultimos.get('citas_hoy'):
+                self._publicar('citas_hoy', citas_hoy)
+        
+        if inicial:
+            self._ultimo_mensaje = db.ultimo_mensaje_id()
+        elif versiones.get('mensajes') != anteriores.get('mensajes'):
+            # De a lotes hasta traer todos (una ráfaga puede superar un lote)
+            while True:
+                nuevos = db.obtener_mensajes_nuevos(self._ultimo_mensaje, EVENTOS_LOTE_MENSAJES)
+                for mensaje in nuevos:
+                    self._publicar('mensaje', mensaje)
+                    self._ultimo_mensaje = mensaje['id']
+                if len(nuevos) < EVENTOS_LOTE_MENSAJES:
+                    break
+        
+        stats = db.obtener_estadisticas()
+        if stats != self._ultimos.get('stats'):
+            self._publicar('stats', stats)
+
+
+canal_eventos = CanalEventos()
+# Hilos del servidor reservados para pestañas conectadas (ver EVENTOS_MAX_PESTANAS)
+cupos_eventos = threading.BoundedSemaphore(EVENTOS_MAX_PESTANAS)
 
 # ==================== API REST ====================
 
 @app.route('/api/stats')
+@con_etag('citas', 'conversaciones', 'mensajes')
 def api_stats():
     """Obtener estadísticas"""
     return jsonify(db.obtener_estadisticas())
 
+@app.route('/api/stats/serie')
+def api_stats_serie():
+    """Serie por día de mensajes y citas: ?dias=30&hasta=YYYY-MM-DD"""
+    dias = min(max(request.args.get('dias', 30, type=int), 1), 366)
+    try:
+        return jsonify(db.obtener_serie_diaria(dias, request.args.get('hasta')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/api/config', methods=['GET', 'POST'])
+@con_etag('configuracion')
 def api_config():
     """Obtener o actualizar configuración"""
     if request.method == 'GET':
         return jsonify(db.get_all_config())
     else:
-        data = request.get_json()
-        for clave, valor in data.items():
-            db.set_config(clave, valor)
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Se esperaba un objeto JSON'}), 400
+        try:
+            db.set_config_many(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        invalidar_panel()
         return jsonify({'success': True})
 
 @app.route('/api/citas', methods=['GET'])
+@con_etag('citas')
 def api_citas():
     """Obtener citas"""
     fecha = request.args.get('fecha')
     if fecha:
         return jsonify(db.obtener_citas_dia(fecha))
-    else:
-        desde = request.args.get('desde', datetime.date.today().isoformat())
-        return jsonify(db.obtener_todas_citas(desde))
+    
+    # Paginado: ?desde=&hasta=&estado=&limite=&cursor=<next_cursor de la página anterior>
+    try:
+        citas, next_cursor = db.obtener_citas_pagina(
+            desde=request.args.get('desde', datetime.date.today().isoformat()),
+            hasta=request.args.get('hasta'),
+            estado=request.args.get('estado'),
+            cursor=request.args.get('cursor'),
+            limite=request.args.get('limite', 50, type=int)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'citas': citas, 'next_cursor': next_cursor})
 
 @app.route('/api/citas', methods=['POST'])
 def api_crear_cita():
@@ -475,11 +785,13 @@ def api_crear_cita():
     hora = data.get('hora')
     cliente = data.get('cliente')
     telefono = data.get('telefono', 'Manual')
+    servicio = data.get('servicio')
     
     if not all([fecha, hora, cliente]):
         return jsonify({'error': 'Faltan datos'}), 400
     
-    exito, mensaje = db.agendar_cita(fecha, hora, cliente, telefono)
+    exito, mensaje = db.agendar_cita(fecha, hora, cliente, telefono, servicio)
+    invalidar_panel()
     return jsonify({'success': exito, 'message': mensaje})
 
 @app.route('/api/citas/<int:cita_id>', methods=['DELETE'])
@@ -489,42 +801,240 @@ def api_cancelar_cita(cita_id):
     return jsonify({'success': True})
 
 @app.route('/api/horarios/<fecha>')
+@con_etag('citas', 'configuracion')
 def api_horarios(fecha):
     """Obtener horarios disponibles para una fecha"""
-    return jsonify(db.obtener_horarios_disponibles(fecha))
+    try:
+        return jsonify(db.obtener_horarios_disponibles(fecha))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/horarios')
+@con_etag('citas', 'configuracion')
+def api_horarios_rango():
+    """
+    Horarios libres de un rango en una llamada:
+    ?desde=YYYY-MM-DD&hasta=YYYY-MM-DD&servicio=Corte&intervalo=30&formato=bits|lista
+    bits (por defecto): {'inicio', 'intervalo', 'turnos', 'dias': {fecha: 'hex'}}
+    lista: {fecha: ["HH:MM", ...]}
+    """
+    desde = request.args.get('desde', datetime.date.today().isoformat())
+    hasta = request.args.get('hasta', desde)
+    servicio = request.args.get('servicio')
+    intervalo = request.args.get('intervalo', type=int)
+    formato = request.args.get('formato', 'bits')
+    if formato not in ('bits', 'lista'):
+        return jsonify({'error': "formato debe ser bits o lista"}), 400
+    
+    try:
+        if formato == 'lista':
+            return jsonify(db.obtener_disponibilidad(desde, hasta, servicio, intervalo))
+        return jsonify(db.obtener_mapa_horarios(desde, hasta, servicio, intervalo))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
 @app.route('/api/conversaciones')
+@con_etag('conversaciones')
 def api_conversaciones():
     """Obtener conversaciones recientes"""
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM conversaciones 
-        ORDER BY ultimo_mensaje DESC 
-        LIMIT 20
-    ''')
-    rows = cursor.fetchall()
-    conn.close()
+    with db.conexion() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM conversaciones 
+            ORDER BY ultimo_mensaje DESC 
+            LIMIT 20
+        ''')
+        rows = cursor.fetchall()
     return jsonify([dict(row) for row in rows])
 
+@app.route('/api/bandeja')
+@con_etag('conversaciones', 'mensajes')
+def api_bandeja():
+    """Bandeja de chats con último mensaje y estado de respuesta: ?estado=activa&limite=30&cursor="""
+    try:
+        conversaciones, next_cursor = db.obtener_bandeja(
+            estado=request.args.get('estado'),
+            cursor=request.args.get('cursor'),
+            limite=request.args.get('limite', 30, type=int)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'conversaciones': conversaciones, 'next_cursor': next_cursor})
+
+@app.route('/api/buscar')
+def api_buscar():
+    """Buscar en el historial: ?q=precio barba&desde=&hasta=&cliente=&limite=20"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'Falta el parámetro q'}), 400
+    
+    try:
+        resultados = db.buscar_mensajes(
+            q,
+            desde=request.args.get('desde'),
+            hasta=request.args.get('hasta'),
+            cliente_nombre=request.args.get('cliente'),
+            limite=min(max(request.args.get('limite', 20, type=int), 1), 100)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(resultados)
+
+@app.route('/api/eventos')
+def api_eventos():
+    """Flujo SSE con los cambios en vivo (ocupa un hilo por pestaña, con cupo)"""
+    if not cupos_eventos.acquire(blocking=False):
+        respuesta = jsonify({'error': 'Demasiadas pestañas conectadas'})
+        respuesta.headers['Retry-After'] = str(EVENTOS_DURACION_SEGUNDOS)
+        return respuesta, 503
+    cola = canal_eventos.suscribir()
+    fin = time.monotonic() + EVENTOS_DURACION_SEGUNDOS
+    
+    def flujo():
+        yield "retry: 5000\n\n"
+        while time.monotonic() < fin:
+            try:
+                evento, datos = cola.get(timeout=EVENTOS_LATIDO_SEGUNDOS)
+            except queue.Empty:
+                yield ": latido\n\n"
+                continue
+            yield f"event: {evento}\ndata: {json.dumps(datos, default=str)}\n\n"
+    
+    def liberar():
+        canal_eventos.desuscribir(cola)
+        cupos_eventos.release()
+    
+    respuesta = Response(flujo(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Que un proxy nginx no lo acumule
+    })
+    # El servidor cierra la respuesta siempre, aunque el flujo no haya empezado
+    respuesta.call_on_close(liberar)
+    return respuesta
+
+@app.route('/api/exportar/<tipo>.<formato>')
+def api_exportar(tipo, formato):
+    """
+    Descarga en streaming: /api/exportar/citas.ics, /api/exportar/mensajes.ndjson, ...
+    ?desde=YYYY-MM-DD&hasta=YYYY-MM-DD&estado=&cliente=&gzip=1
+    """
+    comprimir = request.args.get('gzip') in ('1', 'true')
+    try:
+        partes = exportar.exportar(
+            tipo, formato,
+            desde=request.args.get('desde'),
+            hasta=request.args.get('hasta'),
+            estado=request.args.get('estado'),
+            cliente=request.args.get('cliente'),
+            comprimir=comprimir
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    mimetype = 'application/gzip' if comprimir else exportar.FORMATOS[formato][1]
+    return Response(partes, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{exportar.nombre_archivo(tipo, formato, comprimir)}"',
+    })
+
 @app.route('/api/mensajes/<cliente>')
 def api_mensajes(cliente):
     """Obtener historial de mensajes de un cliente"""
     return jsonify(db.obtener_historial(cliente, limite=50))
 
 
+def workers_por_cpu():
+    """2 x CPU + 1 procesos (lo usual para gunicorn), con tope MAX_WORKERS"""
+    return min(2 * (os.cpu_count() or 1) + 1, MAX_WORKERS)
+
+def servir_produccion(host='0.0.0.0', puerto=PUERTO):
+    """
+    Sirve la app sin el servidor de desarrollo:
+    - gunicorn (Linux/Mac): varios procesos con hilos, app precargada
+    - waitress (Windows, o si no hay gunicorn): un proceso con varios hilos
+    - si no hay ninguno: servidor de Werkzeug con hilos y sin debug
+    Cada proceso suma EVENTOS_MAX_PESTANAS hilos para las pestañas con /api/eventos.
+    """
+    # La base se migra una sola vez acá, antes de crear los workers;
+    # el pool de conexiones abre conexiones propias en cada proceso hijo
+    db.init_database()
+    
+    BaseApplication = None
+    if os.name != 'nt':  # gunicorn no corre en Windows
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            pass
+    
+    if BaseApplication is not None:
+        class Gunicorn(BaseApplication):
+            def load_config(self):
+                opciones = {
+                    'bind': f"{host}:{puerto}",
+                    'workers': workers_por_cpu(),
+                    'worker_class': 'gthread',
+                    'threads': HILOS_POR_WORKER + EVENTOS_MAX_PESTANAS,
+                    'preload_app': True,
+                    'keepalive': KEEPALIVE_SEGUNDOS,
+                    'graceful_timeout': APAGADO_SEGUNDOS,
+                    'worker_exit': lambda server, worker: db.cerrar(),
+                    # /metrics suma los archivos de todos los workers
+                    'post_fork': lambda server, worker: metricas.iniciar_proceso(),
+                }
+                for clave, valor in opciones.items():
+                    self.cfg.set(clave, valor)
+            
+            def load(self):
+                return app
+        
+        print(f"  Servidor: gunicorn ({workers_por_cpu()} workers x {HILOS_POR_WORKER} hilos"
+              f" + {EVENTOS_MAX_PESTANAS} para eventos en vivo)")
+        metricas.activar_multiproceso()
+        Gunicorn().run()
+        return
+    
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    
+    try:
+        if serve is not None:
+            hilos = workers_por_cpu() * HILOS_POR_WORKER
+            print(f"  Servidor: waitress ({hilos} hilos + {EVENTOS_MAX_PESTANAS} para eventos en vivo)")
+            # waitress mantiene keep-alive y al cortar con Ctrl+C cierra los canales abiertos
+            serve(app, host=host, port=puerto, threads=hilos + EVENTOS_MAX_PESTANAS,
+                  channel_timeout=KEEPALIVE_SEGUNDOS * 12, ident='barberia')
+        else:
+            print("  [AVISO] Instala waitress o gunicorn para producción; usando Werkzeug con hilos")
+            app.run(host=host, port=puerto, debug=False, threaded=True)
+    finally:
+        db.cerrar()
+
+
 if __name__ == '__main__':
+    produccion = '--produccion' in sys.argv
+    
     print("\n" + "="*50)
     print("  🌐 Panel Admin - Servidor Iniciado")
     print("="*50)
     print(f"\n  Abre en tu navegador: http://localhost:5000")
     print("\n  Endpoints API disponibles:")
     print("    GET  /api/stats      - Estadísticas")
+    print("    GET  /api/stats/serie?dias=30 - Serie diaria")
     print("    GET  /api/config     - Configuración")
     print("    POST /api/config     - Actualizar config")
-    print("    GET  /api/citas      - Lista de citas")
+    print("    GET  /api/citas      - Lista de citas (paginada, next_cursor)")
     print("    POST /api/citas      - Crear cita")
     print("    GET  /api/horarios/FECHA - Horarios libres")
+    print("    GET  /api/horarios?desde=&hasta=&formato=bits|lista - Turnos libres por rango")
+    print("    GET  /api/buscar?q=  - Buscar en mensajes")
+    print("    GET  /api/bandeja    - Chats con último mensaje (paginada, next_cursor)")
+    print("    GET  /api/eventos    - Cambios en vivo (Server-Sent Events)")
+    print("    GET  /metrics        - Métricas (formato Prometheus)")
+    print("    GET  /api/exportar/citas.ics | mensajes.csv ... - Exportar (?desde=&hasta=&gzip=1)")
     print("\n" + "="*50 + "\n")
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    if produccion:
+        servir_produccion()
+    else:
+        app.run(host='0.0.0.0', port=PUERTO, debug=True)
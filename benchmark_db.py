@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+BENCHMARK DE LA BASE DE DATOS
+=============================
+Genera datos sintéticos a escala de producción y mide cada método público
+de `Database` con uno o varios hilos. El resultado (p50/p95/p99 y
+operaciones por segundo) sale en JSON para comparar corridas entre sí.
+
+Uso:
+    python benchmark_db.py                                  -> escala chica (rápido)
+    python benchmark_db.py --clientes 10000 --mensajes 1000000 --citas 100000
+    python benchmark_db.py --hilos 1,4,8 --iteraciones 500 --salida resultados.json
+    python benchmark_db.py --reusar                         -> no regenerar los datos
+
+También mide el costo de `import database` y de abrir una Database ya migrada.
+
+Nunca usa barberia.db: trabaja sobre su propio archivo (--db).
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from database import Database, normalizar_nombre
+
+NOMBRES = ["Juan", "Carlos", "Luis", "Miguel", "José", "Andrés", "Diego", "Martín", "Fernando", "Pablo",
+           "Sofía", "Lucía", "María", "Valentina", "Camila", "Ana", "Gonzalo", "Nicolás", "Tomás", "Mateo"]
+APELLIDOS = ["González", "Rodríguez", "Pérez", "Fernández", "López", "Martínez", "Gómez", "Díaz",
+             "Sánchez", "Romero", "Benítez", "Acosta", "Ramírez", "Torres", "Ruiz", "Ortiz"]
+FRASES_CLIENTE = ["Hola, tienen turno para hoy?", "Cuanto cuesta el corte?", "Y la barba cuanto sale?",
+                  "A que hora abren mañana?", "Quiero agendar a las {h}", "Perfecto, gracias!",
+                  "Puedo cambiar mi turno?", "Donde quedan?", "Hacen degradado?", "Ok, nos vemos"]
+FRASES_BOT = ["Hola! Tenemos libre a las {h}. Te sirve?", "Corte $10, barba $5, corte+barba $12.",
+              "Perfecto, te anoto! ✅ Cita confirmada a las {h}", "Atendemos de 9:00 a 20:00.",
+              "Claro, que horario te queda mejor?"]
+SERVICIOS = ["Corte", "Corte", "Corte", "Barba", "Corte+Barba"]
+
+LOTE_INSERCION = 50000
+
+
+def _ts(dia, segundos):
+    """Timestamp en el formato de CURRENT_TIMESTAMP"""
+    return (datetime.datetime.combine(dia, datetime.time()) + datetime.timedelta(seconds=segundos)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def generar_datos(database, clientes, mensajes, citas, dias_historia, semilla=42):
+    """Carga datos sintéticos realistas (con triggers activos, como en producción)"""
+    rnd = random.Random(semilla)
+    hoy = datetime.date.today()
+    hora_inicio = int(database.get_config('hora_inicio', 9))
+    hora_fin = int(database.get_config('hora_fin', 20))
+
+    with database.transaccion() as conn:
+        # Clientes (nombres únicos por clave normalizada)
+        nombres = []
+        claves = set()
+        while len(nombres) < clientes:
+            nombre = f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {len(nombres)}"
+            if normalizar_nombre(nombre) not in claves:
+                claves.add(normalizar_nombre(nombre))
+                nombres.append(nombre)
+        conn.executemany('INSERT INTO clientes (nombre, telefono, clave) VALUES (?, ?, ?)',
+                         [(n, f"+59599{rnd.randint(1000000, 9999999)}", normalizar_nombre(n)) for n in nombres])
+        ids = {row['clave']: row['id'] for row in conn.execute('SELECT id, clave FROM clientes')}
+        cliente_ids = [ids[normalizar_nombre(n)] for n in nombres]
+
+        # Una conversación por cliente; ~10% siguen activas
+        conn.executemany('''
+            INSERT INTO conversaciones (cliente_id, cliente_nombre, estado, cita_confirmada)
+            VALUES (?, ?, ?, ?)
+        ''', [(cid, n, 'activa' if rnd.random() < 0.1 else 'cerrada', rnd.random() < 0.4)
+              for cid, n in zip(cliente_ids, nombres)])
+        conv_ids = {row['cliente_id']: row['id'] for row in conn.execute('SELECT id, cliente_id FROM conversaciones')}
+
+    # Mensajes en lotes: rachas de 2-6 mensajes por chat, repartidos en la historia
+    generados = 0
+    while generados < mensajes:
+        filas = []
+        while len(filas) < LOTE_INSERCION and generados + len(filas) < mensajes:
+            i = rnd.randrange(clientes)
+            dia = hoy - datetime.timedelta(days=rnd.randrange(dias_historia))
+            segundos = rnd.randint(9 * 3600, 21 * 3600)
+            for j in range(min(rnd.randint(2, 6), mensajes - generados - len(filas))):
+                es_bot = j % 2
+                frase = rnd.choice(FRASES_BOT if es_bot else FRASES_CLIENTE).format(h=f"{rnd.randint(hora_inicio, hora_fin):02d}:00")
+                filas.append((conv_ids[cliente_ids[i]], cliente_ids[i], nombres[i], es_bot, frase, _ts(dia, segundos + j * 40)))
+        with database.transaccion() as conn:
+            conn.executemany('''
+                INSERT INTO mensajes (conversacion_id, cliente_id, cliente_nombre, es_bot, contenido, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', filas)
+        generados += len(filas)
+        print(f"  mensajes: {generados}/{mensajes}", end="\r")
+    print()
+
+    # Citas: un solo turno confirmado por (fecha, hora); el resto quedan canceladas
+    ocupados = set()
+    filas = []
+    for _ in range(citas):
+        dia = hoy + datetime.timedelta(days=rnd.randint(-dias_historia, 30))
+        hora = f"{rnd.randint(hora_inicio, hora_fin):02d}:00"
+        estado = 'Cancelado' if (dia, hora) in ocupados or rnd.random() < 0.15 else 'Confirmado'
+        if estado == 'Confirmado':
+            ocupados.add((dia, hora))
+        i = rnd.randrange(clientes)
+        filas.append((cliente_ids[i], nombres[i], dia.isoformat(), hora, rnd.choice(SERVICIOS), estado))
+    for inicio in range(0, len(filas), LOTE_INSERCION):
+        with database.transaccion() as conn:
+            conn.executemany('''
+                INSERT INTO citas (cliente_id, cliente_nombre, fecha, hora, servicio, estado)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', filas[inicio:inicio + LOTE_INSERCION])
+
+    with database.conexion() as conn:
+        conn.execute('ANALYZE')
+    return nombres
+
+
+def operaciones(database, nombres, rnd_global):
+    """Método a medir -> función que lo llama con argumentos al azar"""
+    hoy = datetime.date.today()
+    hora_inicio = int(database.get_config('hora_inicio', 9))
+    hora_fin = int(database.get_config('hora_fin', 20))
+    lock = threading.Lock()
+
+    def rnd_int(a, b):
+        with lock:
+            return rnd_global.randint(a, b)
+
+    def cliente():
+        return nombres[rnd_int(0, len(nombres) - 1)]
+
+    def fecha(desde=-30, hasta=30):
+        return (hoy + datetime.timedelta(days=rnd_int(desde, hasta))).isoformat()
+
+    def hora():
+        return f"{rnd_int(hora_inicio, hora_fin):02d}:00"
+
+    return {
+        'get_config': lambda: database.get_config('bot_encendido'),
+        'get_all_config': lambda: database.get_all_config(),
+        'set_config': lambda: database.set_config('benchmark_valor', str(rnd_int(0, 1000))),
+        'set_config_many': lambda: database.set_config_many(
+            {'benchmark_valor': str(rnd_int(0, 1000)), 'benchmark_otro': str(rnd_int(0, 1000))}),
+        'versiones_datos': lambda: database.versiones_datos(),
+        'obtener_citas_dia': lambda: database.obtener_citas_dia(fecha()),
+        'obtener_horarios_disponibles': lambda: database.obtener_horarios_disponibles(fecha()),
+        'obtener_disponibilidad': lambda: database.obtener_disponibilidad(fecha(0, 20), fecha(21, 27)),
+        'obtener_mapa_horarios': lambda: database.obtener_mapa_horarios(fecha(0, 20), fecha(21, 27)),
+        'obtener_panel': lambda: database.obtener_panel(fecha(0, 0)),
+        'obtener_citas_pagina': lambda: database.obtener_citas_pagina(desde=fecha()),
+        'obtener_todas_citas': lambda: database.obtener_todas_citas(),
+        'agendar_cita': lambda: database.agendar_cita(fecha(1, 60), hora(), cliente()),
+        'cancelar_cita': lambda: database.cancelar_cita(fecha(1, 60), cliente()),
+        'obtener_conversacion': lambda: database.obtener_conversacion(cliente()),
+        'agregar_mensaje': lambda: database.agregar_mensaje(cliente(), "Mensaje de benchmark"),
+        'obtener_historial': lambda: database.obtener_historial(cliente(), limite=10),
+        'conversacion_tiene_cita': lambda: database.conversacion_tiene_cita(cliente()),
+        'obtener_bandeja': lambda: database.obtener_bandeja(),
+        'ultimo_mensaje_id': lambda: database.ultimo_mensaje_id(),
+        'obtener_mensajes_nuevos': lambda: database.obtener_mensajes_nuevos(rnd_int(0, database.ultimo_mensaje_id())),
+        'marcar_cita_confirmada': lambda: database.marcar_cita_confirmada(cliente()),
+        'obtener_estadisticas': lambda: database.obtener_estadisticas(),
+        'obtener_serie_diaria': lambda: database.obtener_serie_diaria(30),
+        'buscar_mensajes': lambda: database.buscar_mensajes("precio barba"),
+    }
+
+
+def percentil(ordenados, p):
+    """Percentil por rango más cercano sobre una lista ordenada"""
+    if not ordenados:
+        return 0.0
+    indice = max(0, min(len(ordenados) - 1, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[indice]
+
+
+def medir(funcion, hilos, iteraciones):
+    """Ejecuta `iteraciones` llamadas repartidas en `hilos` hilos"""
+    latencias = []
+    errores = [0]
+    lock = threading.Lock()
+
+    def trabajador(n):
+        propias = []
+        for _ in range(n):
+            inicio = time.perf_counter()
+            try:
+                funcion()
+            except Exception:
+                # Cualquier excepción cuenta como error (y el hilo sigue midiendo)
+                with lock:
+                    errores[0] += 1
+            propias.append(time.perf_counter() - inicio)
+        with lock:
+            latencias.extend(propias)
+
+    por_hilo = [iteraciones // hilos + (1 if i < iteraciones % hilos else 0) for i in range(hilos)]
+    threads = [threading.Thread(target=trabajador, args=(n,)) for n in por_hilo]
+    inicio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        'llamadas': len(latencias),
+        'errores': errores[0],
+        'p50_ms': round(percentil(latencias, 50) * 1000, 3),
+        'p95_ms': round(percentil(latencias, 95) * 1000, 3),
+        'p99_ms': round(percentil(latencias, 99) * 1000, 3),
+        'media_ms': round(sum(latencias) / len(latencias) * 1000, 3) if latencias else 0.0,
+        'ops_por_seg': round(len(latencias) / total, 1) if total else 0.0,
+    }
+
+
+def medir_arranque(db_file, repeticiones=5):
+    """
+    Tiempo de `import database` en un proceso nuevo (menos el arranque del
+    intérprete) y de crear una Database sobre un esquema ya al día.
+    """
+    def proceso(codigo):
+        tiempos = []
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            subprocess.run([sys.executable, '-c', codigo], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            tiempos.append(time.perf_counter() - inicio)
+        return min(tiempos)
+
+    base = proceso('pass')
+    importar = proceso('import database')
+
+    tiempos = []
+    for _ in range(repeticiones):
+        codigo = ("import time, database; t = time.perf_counter(); "
+                  f"database.Database({os.path.abspath(db_file)!r}); print(time.perf_counter() - t)")
+        salida = subprocess.run([sys.executable, '-c', codigo], check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        tiempos.append(float(salida.stdout.strip().splitlines()[-1]))
+
+    return {
+        'import_ms': round((importar - base) * 1000, 2),
+        'database_init_ms': round(min(tiempos) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de database.py con datos sintéticos")
+    parser.add_argument('--db', default='benchmark.db', help="Archivo SQLite a usar (se regenera)")
+    parser.add_argument('--clientes', type=int, default=1000)
+    parser.add_argument('--mensajes', type=int, default=50000)
+    parser.add_argument('--citas', type=int, default=5000)
+    parser.add_argument('--dias', type=int, default=365, help="Días de historia a simular")
+    parser.add_argument('--hilos', default='1,8', help="Niveles de concurrencia, separados por coma")
+    parser.add_argument('--iteraciones', type=int, default=200, help="Llamadas por método y nivel")
+    parser.add_argument('--metodos', help="Solo estos métodos (separados por coma)")
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--reusar', action='store_true', help="Usar los datos ya generados en --db")
+    parser.add_argument('--salida', help="Guardar el JSON en este archivo")
+    args = parser.parse_args()
+
+    if os.path.abspath(args.db) == os.path.abspath('barberia.db'):
+        parser.error("No se puede correr el benchmark sobre barberia.db")
+
+    if not args.reusar:
+        for sufijo in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + sufijo):
+                os.remove(args.db + sufijo)
+
+    database = Database(args.db)
+
+    if args.reusar:
+        with database.conexion() as conn:
+            nombres = [row['nombre'] for row in conn.execute('SELECT nombre FROM clientes')]
+    else:
+        print(f"[BENCH] Generando {args.clientes} clientes, {args.mensajes} mensajes, {args.citas} citas...")
+        inicio = time.perf_counter()
+        nombres = generar_datos(database, args.clientes, args.mensajes, args.citas, args.dias, args.semilla)
+        print(f"[BENCH] Datos generados en {time.perf_counter() - inicio:.1f}s")
+
+    if not nombres:
+        parser.error(f"{args.db} no tiene clientes; correr sin --reusar")
+
+    ops = operaciones(database, nombres, random.Random(args.semilla))
+    if args.metodos:
+        ops = {k: v for k, v in ops.items() if k in args.metodos.split(',')}
+
+    niveles = [int(h) for h in args.hilos.split(',')]
+    resultados = {}
+    for nombre, funcion in ops.items():
+        resultados[nombre] = {}
+        for hilos in niveles:
+            resultados[nombre][str(hilos)] = r = medir(funcion, hilos, args.iteraciones)
+            print(f"[BENCH] {nombre:<30} hilos={hilos:<3} p50={r['p50_ms']:>8}ms "
+                  f"p99={r['p99_ms']:>8}ms {r['ops_por_seg']:>9} ops/s")
+
+    with database.conexion() as conn:
+        conteos = {tabla: conn.execute(f'SELECT COUNT(*) FROM {tabla}').fetchone()[0]
+                   for tabla in ('clientes', 'mensajes', 'citas', 'conversaciones')}
+
+    arranque = medir_arranque(args.db)
+    print(f"[BENCH] import database: {arranque['import_ms']}ms, "
+          f"Database() con esquema al día: {arranque['database_init_ms']}ms")
+
+    informe = {
+        'meta': {
+            'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'plataforma': platform.platform(),
+            'db': args.db,
+            'filas': conteos,
+            'hilos': niveles,
+            'iteraciones': args.iteraciones,
+            'semilla': args.semilla,
+            'arranque': arranque,
+        },
+        'resultados': resultados,
+    }
+    database.cerrar()
+
+    texto = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            f.write(texto)
+        print(f"[BENCH] Resultados guardados en {args.salida}")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
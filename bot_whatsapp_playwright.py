@@ -19,6 +19,7 @@ import google.generativeai as genai
 
 # Importar base de datos
 from database import db
+import metricas
 
 # ==================== CONFIGURACIÓN ====================
 # Modelos de Gemini (TODOS los disponibles gratuitamente)
@@ -130,7 +131,15 @@ def generar_respuesta_ia(mensaje_cliente, cliente_nombre):
     instrucciones = db.get_config('instrucciones', 'Horario: 9am-8pm. Corte $10.')
     
     dia_semana, fecha_hoy, hora_actual = obtener_fecha_hora()
-    horarios_disponibles = db.obtener_horarios_disponibles(fecha_hoy)
+    
+    # Disponibilidad de hoy y los próximos 7 días en una sola consulta
+    hasta = (datetime.date.fromisoformat(fecha_hoy) + datetime.timedelta(days=7)).isoformat()
+    disponibilidad = db.obtener_disponibilidad(fecha_hoy, hasta)
+    horarios_disponibles = disponibilidad.pop(fecha_hoy)
+    proximos_dias = "\n".join(
+        f"  {fecha}: {', '.join(horas[:6]) if horas else 'CERRADO/COMPLETO'}"
+        for fecha, horas in disponibilidad.items()
+    )
     historial = construir_historial_texto(cliente_nombre)
     
     prompt = f"""Eres el asistente virtual de {nombre_negocio}.
@@ -139,6 +148,8 @@ def generar_respuesta_ia(mensaje_cliente, cliente_nombre):
 - Hoy: {dia_semana}, {fecha_hoy}
 - Hora: {hora_actual}
 - Horarios HOY disponibles: {', '.join(horarios_disponibles) if horarios_disponibles else 'COMPLETO'}
+- Proximos dias (algunos horarios libres):
+{proximos_dias}
 
 === INFORMACION DEL NEGOCIO ===
 {instrucciones}
@@ -221,6 +232,12 @@ def main():
     """Función principal del bot"""
     imprimir_banner()
     
+    # Guardar mensajes por lotes en segundo plano (fuera del tiempo de respuesta)
+    db.activar_escritura_diferida()
+    
+    # Latencias de la base del bot en http://127.0.0.1:9101/metrics
+    metricas.iniciar_servidor()
+    
     with sync_playwright() as playwright:
         print("\n[1/4] Abriendo Microsoft Edge...")
         
@@ -486,6 +503,7 @@ def main():
                 time.sleep(3)
         
         browser.close()
+        db.cerrar()
 
 
 if __name__ == "__main__":
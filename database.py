@@ -6,365 +6,2121 @@ Maneja: clientes, citas, conversaciones, configuración
 """
 
 import sqlite3
+import sys
 import datetime
 import json
 import os
+import queue
+import threading
+import contextlib
+import heapq
+import time
+import atexit
+import base64
+import re
+import unicodedata
+
+import metricas
 
 DATABASE_FILE = "barberia.db"
 
-class Database:
-    def __init__(self, db_file=DATABASE_FILE):
+# Conexiones ociosas que se mantienen abiertas por proceso
+POOL_TAMANO = 8
+# Segundos que una conexión espera un lock antes de fallar con "database is locked"
+TIMEOUT_LOCK = 15
+
+# Escritura diferida de mensajes: se vuelca al llegar a N pendientes o cada X segundos
+DIARIO_MAX_PENDIENTES = 50
+DIARIO_INTERVALO_SEGUNDOS = 1.0
+
+# Paginación de citas: tamaño por defecto y máximo por página
+CITAS_POR_PAGINA = 50
+MAX_CITAS_POR_PAGINA = 200
+
+# Bandeja de conversaciones: tamaño por defecto y máximo por página
+CONVERSACIONES_POR_PAGINA = 30
+MAX_CONVERSACIONES_POR_PAGINA = 100
+
+# Máximo de días por consulta de disponibilidad
+MAX_DIAS_DISPONIBILIDAD = 62
+# Servicio de una cita que no lo indica (el DEFAULT de la columna citas.servicio)
+SERVICIO_POR_DEFECTO = 'Corte'
+
+# Archivo de mensajes viejos: filas por transacción y pausa entre lotes
+# (lotes chicos = el lock de escritura nunca se retiene mucho tiempo)
+ARCHIVO_LOTE = 500
+ARCHIVO_PAUSA_SEGUNDOS = 0.05
+
+# Exportaciones: filas por consulta (la conexión se devuelve al pool entre lotes)
+EXPORTAR_LOTE = 200
+
+# Cada cuánto se revisa si otro proceso cambió la configuración (el bot cicla cada 2s)
+CONFIG_REVALIDAR_SEGUNDOS = 1.0
+
+# Respaldos en caliente: carpeta, cuántos se conservan y páginas copiadas por paso
+# (entre paso y paso se suelta el lock, así el bot y el panel no quedan esperando)
+RESPALDO_DIR = "respaldos"
+RESPALDOS_CONSERVAR = 7
+RESPALDO_PAGINAS = 256
+RESPALDO_PAUSA_SEGUNDOS = 0.01
+
+# PRAGMAs por conexión (se aplican una sola vez, al abrirla)
+PRAGMAS_CONEXION = (
+    'PRAGMA synchronous = NORMAL',   # Seguro con WAL, sin fsync en cada commit
+    'PRAGMA cache_size = -8000',     # ~8 MB de caché de páginas
+    'PRAGMA mmap_size = 67108864',   # 64 MB de lectura por memoria mapeada
+    'PRAGMA temp_store = MEMORY',
+)
+
+
+class PoolConexiones:
+    """
+    Pool pequeño de conexiones SQLite reutilizables.
+    - Cada hilo toma una conexión del pool y la devuelve al terminar
+    - Si el mismo hilo vuelve a pedir conexión, recibe la que ya tiene
+    - Tras un fork (workers del panel) el proceso hijo abre las suyas
+    """
+    
+    def __init__(self, db_file, tamano=POOL_TAMANO):
         self.db_file = db_file
-        self.init_database()
+        self.tamano = tamano
+        self._libres = queue.LifoQueue()
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._heredadas = []
     
-    def get_connection(self):
-        """Obtiene conexión a la base de datos"""
-        conn = sqlite3.connect(self.db_file)
+    def abrir(self):
+        """Abre una conexión nueva con los PRAGMAs de rendimiento"""
+        conn = sqlite3.connect(self.db_file, timeout=TIMEOUT_LOCK, check_same_thread=False)
         conn.row_factory = sqlite3.Row  # Para acceder por nombre de columna
+        for pragma in PRAGMAS_CONEXION:
+            conn.execute(pragma)
         return conn
     
-    def init_database(self):
-        """Crea las tablas si no existen"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def _verificar_fork(self):
+        """Descarta (sin cerrar) las conexiones heredadas del proceso padre"""
+        if os.getpid() != self._pid:
+            while not self._libres.empty():
+                self._heredadas.append(self._libres.get_nowait())
+            self._local = threading.local()
+            self._pid = os.getpid()
+    
+    @contextlib.contextmanager
+    def conexion(self):
+        """Presta una conexión del pool durante el bloque `with`"""
+        self._verificar_fork()
         
-        # Tabla de configuración
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS configuracion (
-                clave TEXT PRIMARY KEY,
-                valor TEXT
-            )
-        ''')
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            # Reentrante: el hilo ya tiene una conexión prestada
+            yield conn
+            return
         
-        # Tabla de clientes
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS clientes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT NOT NULL,
-                telefono TEXT,
-                creado_en DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        try:
+            conn = self._libres.get_nowait()
+        except queue.Empty:
+            conn = self.abrir()
         
-        # Tabla de citas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS citas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                cliente_id INTEGER,
-                cliente_nombre TEXT,
-                fecha DATE NOT NULL,
-                hora TIME NOT NULL,
-                servicio TEXT DEFAULT 'Corte',
-                estado TEXT DEFAULT 'Confirmado',
-                creado_en DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (cliente_id) REFERENCES clientes(id)
-            )
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()  # Nunca devolver una transacción a medias
+            if self._libres.qsize() < self.tamano:
+                self._libres.put(conn)
+            else:
+                conn.close()
+    
+    def cerrar(self):
+        """Cierra todas las conexiones ociosas"""
+        while not self._libres.empty():
+            self._libres.get_nowait().close()
+
+
+class DiarioMensajes:
+    """
+    Buffer de escritura diferida para agregar_mensaje.
+    - agregar() solo encola en memoria (no toca SQLite ni espera al volcado)
+    - Un hilo de fondo vuelca el buffer en una transacción con executemany
+      al llegar a `max_pendientes` o cada `intervalo` segundos
+    - El lote que se está escribiendo queda en `_en_vuelo` hasta el commit:
+      historial() lo sigue viendo, sin huecos ni duplicados
+    """
+    
+    def __init__(self, database, max_pendientes=DIARIO_MAX_PENDIENTES,
+                 intervalo=DIARIO_INTERVALO_SEGUNDOS):
+        self.database = database
+        self.max_pendientes = max_pendientes
+        self.intervalo = intervalo
+        self._buffer = []
+        self._en_vuelo = []
+        # Protege solo las listas en memoria: nunca se retiene durante la escritura
+        self._lock = threading.Lock()
+        # Un volcado a la vez (hilo de fondo, respaldar, detener)
+        self._volcando = threading.Lock()
+        # Para que historial() sepa si un commit ocurrió mientras leía
+        self._confirmando = False
+        self._volcados = 0
+        self._despertar = threading.Event()
+        self._detenido = False
+        self._hilo = threading.Thread(target=self._bucle, name="diario-mensajes", daemon=True)
+        self._hilo.start()
+    
+    def agregar(self, cliente_nombre, contenido, es_bot):
+        """Encola un mensaje con la hora actual (UTC, como CURRENT_TIMESTAMP)"""
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._buffer.append((cliente_nombre, contenido, 1 if es_bot else 0, timestamp))
+            lleno = len(self._buffer) >= self.max_pendientes
+        if lleno:
+            self._despertar.set()
+    
+    def historial(self, cliente_nombre, limite):
+        """Historial guardado + pendientes, sin duplicar ni perder mensajes"""
+        while True:
+            with self._lock:
+                confirmando = self._confirmando
+                volcados = self._volcados
+                pendientes = self.pendientes(cliente_nombre)
+            if confirmando:
+                # Commit en curso (dura milisegundos): el lote puede estar o no en la lectura
+                time.sleep(0.001)
+                continue
+            guardados = self.database._historial_db(cliente_nombre, limite)
+            with self._lock:
+                # Sin commits mientras se leía: cada mensaje está en una sola de las dos listas
+                if not self._confirmando and self._volcados == volcados:
+                    break
+        mensajes = guardados + pendientes
+        return mensajes[-limite:] if limite > 0 else []
+    
+    def pendientes(self, cliente_nombre):
+        """Mensajes de un cliente que aún no llegaron a la base de datos (llamar con el lock tomado)"""
+        clave = normalizar_nombre(cliente_nombre)
+        return [
+            {'id': None, 'conversacion_id': None, 'cliente_nombre': nombre,
+             'es_bot': es_bot, 'contenido': contenido, 'timestamp': timestamp, 'cliente_id': None}
+            for nombre, contenido, es_bot, timestamp in self._en_vuelo + self._buffer
+            if normalizar_nombre(nombre) == clave
+        ]
+    
+    def volcar(self):
+        """Escribe todo el buffer en una sola transacción"""
+        with self._volcando:
+            # Se saca el lote del buffer: agregar() sigue encolando mientras se escribe
+            with self._lock:
+                if not self._buffer:
+                    return 0
+                lote = self._en_vuelo = self._buffer
+                self._buffer = []
+            
+            try:
+                with self.database.transaccion() as conn:
+                    cursor = conn.cursor()
+                    conversaciones = {}
+                    filas = []
+                    for cliente_nombre, contenido, es_bot, timestamp in lote:
+                        if cliente_nombre not in conversaciones:
+                            conversaciones[cliente_nombre] = self.database._conversacion_activa(cursor, cliente_nombre)
+                        conv_id, cliente_id = conversaciones[cliente_nombre]
+                        filas.append((conv_id, cliente_id, cliente_nombre, contenido, es_bot, timestamp))
+                    
+                    cursor.executemany('''
+                        INSERT INTO mensajes (conversacion_id, cliente_id, cliente_nombre, contenido, es_bot, timestamp)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', filas)
+                    
+                    # Última actividad de cada conversación tocada
+                    ultimos = {}
+                    for conv_id, _, _, _, _, timestamp in filas:
+                        ultimos[conv_id] = timestamp
+                    cursor.executemany('''
+                        UPDATE conversaciones SET ultimo_mensaje = ? WHERE id = ?
+                    ''', [(timestamp, conv_id) for conv_id, timestamp in ultimos.items()])
+                    
+                    # Al salir del bloque se hace el commit
+                    with self._lock:
+                        self._confirmando = True
+            except BaseException:
+                # Los mensajes vuelven al principio del buffer; se reintenta en el próximo ciclo
+                with self._lock:
+                    self._buffer = lote + self._buffer
+                    self._en_vuelo = []
+                    self._confirmando = False
+                raise
+            
+            with self._lock:
+                self._en_vuelo = []
+                self._confirmando = False
+                self._volcados += 1
+            return len(lote)
+    
+    def _bucle(self):
+        """Hilo de fondo: vuelca por tamaño o por tiempo"""
+        while not self._detenido:
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+            try:
+                self.volcar()
+            except Exception as e:
+                # Los mensajes siguen en el buffer; se reintenta en el próximo ciclo
+                print(f"[DB] Error volcando mensajes: {e}")
+    
+    def detener(self):
+        """Vuelca lo pendiente y detiene el hilo de fondo"""
+        self._detenido = True
+        self._despertar.set()
+        self._hilo.join(timeout=5)
+        self.volcar()
+
+
+# ==================== MIGRACIONES ====================
+# Cada paso se aplica una sola vez, en orden, y queda registrado en
+# PRAGMA user_version. Para cambiar el esquema se AGREGA un paso nuevo al
+# final de MIGRACIONES; nunca se edita uno que ya se publicó.
+
+def _migracion_esquema_base(cursor):
+    """Tablas originales y configuración por defecto"""
+    # Tabla de configuración
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS configuracion (
+            clave TEXT PRIMARY KEY,
+            valor TEXT
+        )
+    ''')
+    
+    # Tabla de clientes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS clientes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            telefono TEXT,
+            creado_en DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Tabla de citas
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS citas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_id INTEGER,
+            cliente_nombre TEXT,
+            fecha DATE NOT NULL,
+            hora TIME NOT NULL,
+            servicio TEXT DEFAULT 'Corte',
+            estado TEXT DEFAULT 'Confirmado',
+            creado_en DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (cliente_id) REFERENCES clientes(id)
+        )
+    ''')
+    
+    # Tabla de conversaciones (historial por chat)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversaciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_nombre TEXT NOT NULL,
+            estado TEXT DEFAULT 'activa',
+            ultimo_mensaje DATETIME DEFAULT CURRENT_TIMESTAMP,
+            cita_confirmada INTEGER DEFAULT 0
+        )
+    ''')
+    
+    # Tabla de mensajes (historial de cada conversación)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mensajes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversacion_id INTEGER,
+            cliente_nombre TEXT,
+            es_bot INTEGER DEFAULT 0,
+            contenido TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversacion_id) REFERENCES conversaciones(id)
+        )
+    ''')
+    
+    # Insertar configuración por defecto si no existe
+    cursor.execute('''
+        INSERT OR IGNORE INTO configuracion (clave, valor) VALUES
+        ('nombre_negocio', 'Barbería Z'),
+        ('api_key', ''),
+        ('bot_encendido', 'true'),
+        ('instrucciones', 'Horario: 9am-8pm. Corte $10. Barba $5. Corte+Barba $12.'),
+        ('contactos_ignorados', '[]'),
+        ('hora_inicio', '9'),
+        ('hora_fin', '20')
+    ''')
+
+
+def _reconstruir_estadisticas(cursor):
+    """Recalcula estadisticas_diarias y contadores desde las tablas (backfill)"""
+    cursor.execute('DELETE FROM estadisticas_diarias')
+    cursor.execute('''
+        INSERT INTO estadisticas_diarias (fecha, mensajes)
+        SELECT DATE(timestamp), COUNT(*) FROM mensajes GROUP BY DATE(timestamp)
+    ''')
+    # "WHERE true" evita la ambigüedad de INSERT ... SELECT ... ON CONFLICT
+    cursor.execute('''
+        INSERT INTO estadisticas_diarias (fecha, citas_confirmadas)
+        SELECT fecha, COUNT(*) FROM citas WHERE estado = 'Confirmado' GROUP BY fecha
+        ON CONFLICT (fecha) DO UPDATE SET citas_confirmadas = excluded.citas_confirmadas
+    ''')
+    cursor.execute('''
+        INSERT INTO estadisticas_diarias (fecha, citas_agendadas)
+        SELECT DATE(creado_en), COUNT(*) FROM citas WHERE true GROUP BY DATE(creado_en)
+        ON CONFLICT (fecha) DO UPDATE SET citas_agendadas = excluded.citas_agendadas
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO contadores (clave, valor)
+        SELECT 'conversaciones_activas', COUNT(*) FROM conversaciones WHERE estado = 'activa'
+    ''')
+
+def _migracion_turno_unico(cursor):
+    """Un solo turno confirmado por fecha y hora"""
+    # Si ya había turnos dobles, se conserva el primero agendado; los demás se
+    # cancelan y se listan para poder avisarles a esos clientes
+    duplicadas = cursor.execute('''
+        SELECT id, fecha, hora, cliente_nombre FROM citas
+        WHERE estado = 'Confirmado' AND id NOT IN (
+            SELECT MIN(id) FROM citas WHERE estado = 'Confirmado' GROUP BY fecha, hora
+        )
+        ORDER BY fecha, hora, id
+    ''').fetchall()
+    for id_cita, fecha, hora, cliente in duplicadas:
+        print(f"[DB] Turno doble: se cancela la cita {id_cita} de {cliente} ({fecha} {hora})")
+    cursor.executemany(
+        "UPDATE citas SET estado = 'Cancelado' WHERE id = ?",
+        [(row[0],) for row in duplicadas]
+    )
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_citas_turno_unico
+        ON citas (fecha, hora) WHERE estado = 'Confirmado'
+    ''')
+
+def _migracion_estadisticas(cursor):
+    """Tablas de contadores mantenidas por triggers + backfill inicial"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS estadisticas_diarias (
+            fecha DATE PRIMARY KEY,
+            mensajes INTEGER NOT NULL DEFAULT 0,
+            citas_confirmadas INTEGER NOT NULL DEFAULT 0,
+            citas_agendadas INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS contadores (
+            clave TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Mensajes por día (de timestamp). Sin trigger de DELETE: archivar
+    # mensajes viejos no debe borrar la serie histórica.
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_estadisticas_mensajes AFTER INSERT ON mensajes
+        BEGIN
+            INSERT INTO estadisticas_diarias (fecha, mensajes) VALUES (DATE(NEW.timestamp), 1)
+            ON CONFLICT (fecha) DO UPDATE SET mensajes = mensajes + 1;
+        END
+    ''')
+    
+    # Citas confirmadas por fecha de la cita y citas agendadas por día de reserva
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_estadisticas_citas_insert AFTER INSERT ON citas
+        BEGIN
+            INSERT INTO estadisticas_diarias (fecha, citas_confirmadas)
+            VALUES (NEW.fecha, NEW.estado = 'Confirmado')
+            ON CONFLICT (fecha) DO UPDATE SET citas_confirmadas = citas_confirmadas + (NEW.estado = 'Confirmado');
+            INSERT INTO estadisticas_diarias (fecha, citas_agendadas)
+            VALUES (DATE(COALESCE(NEW.creado_en, CURRENT_TIMESTAMP)), 1)
+            ON CONFLICT (fecha) DO UPDATE SET citas_agendadas = citas_agendadas + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_estadisticas_citas_update AFTER UPDATE OF fecha, estado ON citas
+        BEGIN
+            UPDATE estadisticas_diarias SET citas_confirmadas = citas_confirmadas - (OLD.estado = 'Confirmado')
+            WHERE fecha = OLD.fecha;
+            INSERT INTO estadisticas_diarias (fecha, citas_confirmadas)
+            VALUES (NEW.fecha, NEW.estado = 'Confirmado')
+            ON CONFLICT (fecha) DO UPDATE SET citas_confirmadas = citas_confirmadas + (NEW.estado = 'Confirmado');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_estadisticas_citas_delete AFTER DELETE ON citas
+        BEGIN
+            UPDATE estadisticas_diarias SET citas_confirmadas = citas_confirmadas - (OLD.estado = 'Confirmado')
+            WHERE fecha = OLD.fecha;
+        END
+    ''')
+    
+    # Conversaciones activas (estado actual, no por día)
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_contadores_conv_insert AFTER INSERT ON conversaciones
+        BEGIN
+            UPDATE contadores SET valor = valor + (NEW.estado = 'activa') WHERE clave = 'conversaciones_activas';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_contadores_conv_update AFTER UPDATE OF estado ON conversaciones
+        BEGIN
+            UPDATE contadores SET valor = valor - (OLD.estado = 'activa') + (NEW.estado = 'activa')
+            WHERE clave = 'conversaciones_activas';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_contadores_conv_delete AFTER DELETE ON conversaciones
+        BEGIN
+            UPDATE contadores SET valor = valor - (OLD.estado = 'activa') WHERE clave = 'conversaciones_activas';
+        END
+    ''')
+    
+    _reconstruir_estadisticas(cursor)
+
+
+def normalizar_nombre(nombre):
+    """Clave de identidad del cliente: sin mayúsculas, acentos ni espacios de más"""
+    texto = unicodedata.normalize('NFKD', str(nombre or ''))
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(texto.casefold().split())
+
+def _buscar_o_crear_cliente(cursor, nombre, telefono=None, crear=True):
+    """id del cliente por su clave normalizada (None si no existe y crear=False)"""
+    clave = normalizar_nombre(nombre)
+    row = cursor.execute('SELECT id FROM clientes WHERE clave = ?', (clave,)).fetchone()
+    if row:
+        return row[0]
+    if not crear:
+        return None
+    cursor.execute('''
+        INSERT INTO clientes (nombre, telefono, clave) VALUES (?, ?, ?)
+    ''', (str(nombre or '').strip() or clave, telefono, clave))
+    return cursor.lastrowid
+
+def _migracion_clientes(cursor):
+    """Identidad de cliente normalizada y cliente_id en citas, conversaciones y mensajes"""
+    cursor.execute('ALTER TABLE clientes ADD COLUMN clave TEXT')
+    cursor.execute('ALTER TABLE conversaciones ADD COLUMN cliente_id INTEGER REFERENCES clientes(id)')
+    cursor.execute('ALTER TABLE mensajes ADD COLUMN cliente_id INTEGER REFERENCES clientes(id)')
+    
+    # Clientes ya cargados: el primero con cada clave se queda con ella
+    vistas = set()
+    for row in cursor.execute('SELECT id, nombre FROM clientes ORDER BY id').fetchall():
+        clave = normalizar_nombre(row[1])
+        if clave not in vistas:
+            vistas.add(clave)
+            cursor.execute('UPDATE clientes SET clave = ? WHERE id = ?', (clave, row[0]))
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_clientes_clave ON clientes (clave)')
+    
+    # Backfill: un cliente por cada nombre distinto (en todas sus variantes)
+    nombres = [row[0] for row in cursor.execute('''
+        SELECT cliente_nombre FROM citas WHERE cliente_nombre IS NOT NULL
+        UNION SELECT cliente_nombre FROM conversaciones
+        UNION SELECT cliente_nombre FROM mensajes WHERE cliente_nombre IS NOT NULL
+    ''').fetchall()]
+    for nombre in nombres:
+        _buscar_o_crear_cliente(cursor, nombre)
+    
+    # Una sola pasada por tabla, resolviendo cada fila por el índice de clave
+    cursor.connection.create_function('normalizar_nombre', 1, normalizar_nombre, deterministic=True)
+    for tabla in ('citas', 'conversaciones', 'mensajes'):
+        cursor.execute(f'''
+            UPDATE {tabla} SET cliente_id = (
+                SELECT id FROM clientes WHERE clave = normalizar_nombre({tabla}.cliente_nombre)
+            ) WHERE cliente_nombre IS NOT NULL
         ''')
-        
-        # Tabla de conversaciones (historial por chat)
+    
+    # Búsquedas por cliente: índices sobre la clave entera
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_citas_fecha_cliente_id ON citas (fecha, cliente_id, estado)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversaciones_cliente_id ON conversaciones (cliente_id, estado, cita_confirmada)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mensajes_cliente_id ON mensajes (cliente_id, timestamp)')
+    
+    # Los índices por nombre ya no los usa ninguna consulta
+    cursor.execute('DROP INDEX IF EXISTS idx_citas_fecha_cliente')
+    cursor.execute('DROP INDEX IF EXISTS idx_conversaciones_cliente_estado')
+    cursor.execute('DROP INDEX IF EXISTS idx_mensajes_cliente_timestamp')
+
+def _migracion_busqueda(cursor):
+    """Índice FTS5 sobre mensajes.contenido, sincronizado por triggers"""
+    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversaciones (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                cliente_nombre TEXT NOT NULL,
-                estado TEXT DEFAULT 'activa',
-                ultimo_mensaje DATETIME DEFAULT CURRENT_TIMESTAMP,
-                cita_confirmada INTEGER DEFAULT 0
+            CREATE VIRTUAL TABLE IF NOT EXISTS mensajes_fts USING fts5(
+                contenido,
+                content='mensajes', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
             )
         ''')
+    except sqlite3.OperationalError as e:
+        # SQLite sin FTS5: buscar_mensajes usa LIKE como respaldo
+        print(f"[DB] FTS5 no disponible ({e}); búsqueda sin índice")
+        return
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_mensajes_fts_insert AFTER INSERT ON mensajes
+        BEGIN
+            INSERT INTO mensajes_fts (rowid, contenido) VALUES (NEW.id, NEW.contenido);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_mensajes_fts_delete AFTER DELETE ON mensajes
+        BEGIN
+            INSERT INTO mensajes_fts (mensajes_fts, rowid, contenido) VALUES ('delete', OLD.id, OLD.contenido);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_mensajes_fts_update AFTER UPDATE OF contenido ON mensajes
+        BEGIN
+            INSERT INTO mensajes_fts (mensajes_fts, rowid, contenido) VALUES ('delete', OLD.id, OLD.contenido);
+            INSERT INTO mensajes_fts (rowid, contenido) VALUES (NEW.id, NEW.contenido);
+        END
+    ''')
+    
+    # Backfill de los mensajes existentes
+    cursor.execute("INSERT INTO mensajes_fts (mensajes_fts) VALUES ('rebuild')")
+
+
+# Tablas con contador de cambios (ETag de las rutas de lectura del panel)
+TABLAS_VERSIONADAS = ('citas', 'conversaciones', 'mensajes')
+
+def _migracion_versiones(cursor):
+    """Un contador por tabla que sube con cada INSERT/UPDATE/DELETE"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS versiones_tablas (
+            tabla TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    for tabla in TABLAS_VERSIONADAS:
+        cursor.execute('INSERT OR IGNORE INTO versiones_tablas (tabla, version) VALUES (?, 0)', (tabla,))
+        for operacion in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{tabla}_version_{operacion.lower()} AFTER {operacion} ON {tabla}
+                BEGIN UPDATE versiones_tablas SET version = version + 1 WHERE tabla = '{tabla}'; END
+            ''')
+
+
+MIGRACIONES = [
+    (1, "Esquema base", _migracion_esquema_base),
+    (2, "Índices para consultas frecuentes", [
+        # obtener_citas_dia / horario ocupado en agendar_cita / estadísticas
+        'CREATE INDEX IF NOT EXISTS idx_citas_fecha_estado_hora ON citas (fecha, estado, hora)',
+        # Cita del cliente ese día en agendar_cita y cancelar_cita
+        'CREATE INDEX IF NOT EXISTS idx_citas_fecha_cliente ON citas (fecha, LOWER(cliente_nombre), estado)',
+        # obtener_historial (ya ordenado, sin sort temporal)
+        'CREATE INDEX IF NOT EXISTS idx_mensajes_cliente_timestamp ON mensajes (cliente_nombre, timestamp)',
+        # obtener_conversacion / conversacion_tiene_cita (cubriente)
+        'CREATE INDEX IF NOT EXISTS idx_conversaciones_cliente_estado ON conversaciones (cliente_nombre, estado, cita_confirmada)',
+        # Conteo de conversaciones activas
+        'CREATE INDEX IF NOT EXISTS idx_conversaciones_estado ON conversaciones (estado)',
+    ]),
+    (3, "Versión de configuración para la caché", [
+        '''
+        CREATE TABLE IF NOT EXISTS config_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+        ''',
+        'INSERT OR IGNORE INTO config_version (id, version) VALUES (1, 0)',
+        # Cualquier escritura a configuracion (panel, bot, scripts) sube la versión
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_configuracion_insert AFTER INSERT ON configuracion
+        BEGIN UPDATE config_version SET version = version + 1 WHERE id = 1; END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_configuracion_update AFTER UPDATE ON configuracion
+        BEGIN UPDATE config_version SET version = version + 1 WHERE id = 1; END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_configuracion_delete AFTER DELETE ON configuracion
+        BEGIN UPDATE config_version SET version = version + 1 WHERE id = 1; END
+        ''',
+    ]),
+    (4, "Un solo turno confirmado por fecha y hora", _migracion_turno_unico),
+    (5, "Configuración de turnos: intervalo, duración por servicio y días cerrados", [
+        # intervalo_turnos: minutos entre inicios de turno (15/20/30/60)
+        # duraciones_servicio: JSON {"Barba": 15, ...}; si falta, dura un intervalo
+        # dias_cerrados: JSON con días de la semana (0=Lunes) y/o fechas "YYYY-MM-DD"
+        '''
+        INSERT OR IGNORE INTO configuracion (clave, valor) VALUES
+        ('intervalo_turnos', '60'),
+        ('duraciones_servicio', '{}'),
+        ('dias_cerrados', '[]')
+        ''',
+    ]),
+    (6, "Estadísticas diarias mantenidas por triggers", _migracion_estadisticas),
+    (7, "Retención y archivo de mensajes", [
+        # Selección de mensajes/conversaciones viejos para archivar
+        'CREATE INDEX IF NOT EXISTS idx_mensajes_timestamp ON mensajes (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion ON mensajes (conversacion_id)',
+        "INSERT OR IGNORE INTO configuracion (clave, valor) VALUES ('dias_retencion_mensajes', '90')",
+    ]),
+    (8, "Índice para paginar citas por (fecha, hora, id)", [
+        'CREATE INDEX IF NOT EXISTS idx_citas_fecha_hora ON citas (fecha, hora)',
+    ]),
+    (9, "Búsqueda de texto completo en mensajes (FTS5)", _migracion_busqueda),
+    (10, "Identidad de cliente normalizada", _migracion_clientes),
+    (11, "Contadores de cambios por tabla", _migracion_versiones),
+    (12, "Índices para la bandeja de conversaciones", [
+        # Orden de la bandeja (con y sin filtro de estado) y su cursor
+        'CREATE INDEX IF NOT EXISTS idx_conversaciones_ultimo ON conversaciones (ultimo_mensaje, id)',
+        'CREATE INDEX IF NOT EXISTS idx_conversaciones_estado_ultimo ON conversaciones (estado, ultimo_mensaje, id)',
+        'DROP INDEX IF EXISTS idx_conversaciones_estado',
+        # Último mensaje del bot / del cliente por conversación (MAX(id) sin recorrer)
+        'CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion_bot ON mensajes (conversacion_id, es_bot)',
+        'DROP INDEX IF EXISTS idx_mensajes_conversacion',
+    ]),
+]
+
+# Esquema de la base de archivo (barberia_archivo.db): mismas columnas, ids originales.
+# El cliente se identifica por su clave normalizada (no por clientes.id: el
+# archivo es otra base y sobrevive a una restauración de la principal).
+ESQUEMA_ARCHIVO = '''
+    CREATE TABLE IF NOT EXISTS mensajes (
+        id INTEGER PRIMARY KEY,
+        conversacion_id INTEGER,
+        cliente_nombre TEXT,
+        es_bot INTEGER DEFAULT 0,
+        contenido TEXT,
+        timestamp DATETIME,
+        cliente_clave TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion ON mensajes (conversacion_id);
+    CREATE TABLE IF NOT EXISTS conversaciones (
+        id INTEGER PRIMARY KEY,
+        cliente_nombre TEXT NOT NULL,
+        estado TEXT,
+        ultimo_mensaje DATETIME,
+        cita_confirmada INTEGER DEFAULT 0,
+        cliente_clave TEXT
+    );
+'''
+# Versión del esquema de archivo (PRAGMA user_version del archivo)
+VERSION_ARCHIVO = 1
+
+def _migrar_archivo(conn):
+    """Agrega y completa cliente_clave en archivos creados antes de la identidad normalizada"""
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= VERSION_ARCHIVO:
+        return
+    conn.create_function('normalizar_nombre', 1, normalizar_nombre, deterministic=True)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if conn.execute('PRAGMA user_version').fetchone()[0] < VERSION_ARCHIVO:
+            for tabla in ('mensajes', 'conversaciones'):
+                columnas = {row[1] for row in conn.execute(f'PRAGMA table_info({tabla})')}
+                if 'cliente_clave' not in columnas:
+                    conn.execute(f'ALTER TABLE {tabla} ADD COLUMN cliente_clave TEXT')
+                conn.execute(f'''
+                    UPDATE {tabla} SET cliente_clave = normalizar_nombre(cliente_nombre)
+                    WHERE cliente_clave IS NULL
+                ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_mensajes_clave_timestamp ON mensajes (cliente_clave, timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_conversaciones_clave ON conversaciones (cliente_clave, ultimo_mensaje)')
+            conn.execute('DROP INDEX IF EXISTS idx_mensajes_cliente_timestamp')
+            conn.execute('DROP INDEX IF EXISTS idx_conversaciones_cliente')
+            conn.execute(f'PRAGMA user_version = {VERSION_ARCHIVO}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+VERSION_ESQUEMA = MIGRACIONES[-1][0]
+
+# Consultas del camino caliente con parámetros de ejemplo.
+# verificar_planes() falla si alguna cae en un SCAN de tabla completa.
+CONSULTAS_CRITICAS = {
+    'obtener_citas_dia': (
+        "SELECT * FROM citas WHERE fecha = ? AND estado = 'Confirmado' ORDER BY hora",
+        ('2025-01-01',)),
+    'agendar_cita': (
+        "SELECT id, hora, servicio, cliente_id FROM citas WHERE fecha = ? AND estado = 'Confirmado'",
+        ('2025-01-01',)),
+    'cancelar_cita': (
+        "UPDATE citas SET estado = 'Cancelado' WHERE fecha = ? AND cliente_id = ? AND estado = 'Confirmado'",
+        ('2025-01-01', 1)),
+    'cliente_por_clave': (
+        "SELECT id FROM clientes WHERE clave = ?",
+        ('cliente',)),
+    'obtener_historial': (
+        "SELECT * FROM mensajes WHERE cliente_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (1, 10)),
+    'obtener_conversacion': (
+        "SELECT * FROM conversaciones WHERE cliente_id = ? AND estado = 'activa'",
+        (1,)),
+    'conversacion_tiene_cita': (
+        "SELECT cita_confirmada FROM conversaciones WHERE cliente_id = ? AND estado = 'activa'",
+        (1,)),
+    'obtener_disponibilidad': (
+        "SELECT fecha, hora, servicio FROM citas WHERE fecha BETWEEN ? AND ? AND estado = 'Confirmado'",
+        ('2025-01-01', '2025-01-07')),
+    'obtener_citas_pagina': (
+        "SELECT * FROM citas WHERE (fecha, hora, id) > (?, ?, ?) AND fecha <= ? ORDER BY fecha, hora, id LIMIT ?",
+        ('2025-01-01', '', 0, '2025-12-31', 50)),
+    'obtener_estadisticas': (
+        "SELECT * FROM estadisticas_diarias WHERE fecha = ?",
+        ('2025-01-01',)),
+    'obtener_bandeja': (
+        "SELECT id FROM conversaciones WHERE estado = ? AND (ultimo_mensaje, id) < (?, ?) "
+        "ORDER BY ultimo_mensaje DESC, id DESC LIMIT ?",
+        ('activa', '2025-01-01 00:00:00', 0, 30)),
+    'obtener_bandeja.ultimo_mensaje': (
+        "SELECT MAX(id) FROM mensajes WHERE conversacion_id = ? AND es_bot = ?",
+        (1, 0)),
+    'iterar_mensajes': (
+        "SELECT * FROM mensajes WHERE (timestamp, id) > (?, ?) AND timestamp < ? ORDER BY timestamp, id LIMIT ?",
+        ('2025-01-01 00:00:00', 0, '2026-01-01', 200)),
+    'obtener_serie_diaria': (
+        "SELECT * FROM estadisticas_diarias WHERE fecha BETWEEN ? AND ?",
+        ('2025-01-01', '2025-01-31')),
+}
+
+
+def _a_minutos(hora):
+    """'HH:MM' -> minutos desde medianoche (None si no se puede leer)"""
+    try:
+        h, m = str(hora).strip().split(':')[:2]
+        return int(h) * 60 + int(m)
+    except ValueError:
+        return None
+
+def _a_hora(minutos):
+    """Minutos desde medianoche -> 'HH:MM'"""
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+def _consulta_fts(texto):
+    """
+    Convierte texto libre en una consulta FTS5 segura: cada palabra entre
+    comillas y con prefijo ("barb"* encuentra barba, barbas...), unidas con
+    OR para que bm25 ordene primero los mensajes con más coincidencias.
+    None si no hay palabras.
+    """
+    palabras = re.findall(r'\w+', texto or '')
+    if not palabras:
+        return None
+    return ' OR '.join(f'"{p}"*' for p in palabras)
+
+def _codificar_cursor(*valores):
+    """Cursor opaco para paginación (JSON en base64 url-safe)"""
+    return base64.urlsafe_b64encode(json.dumps(valores).encode('utf-8')).decode('ascii')
+
+def _decodificar_cursor(cursor, cantidad):
+    """Inverso de _codificar_cursor; ValueError si el cursor no es válido"""
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError("Cursor inválido")
+    if not isinstance(valores, list) or len(valores) != cantidad:
+        raise ValueError("Cursor inválido")
+    return valores
+
+
+def _validar_entero(minimo, maximo):
+    def validar(valor):
+        if isinstance(valor, bool):
+            raise ValueError("debe ser un número entero")
+        try:
+            numero = int(str(valor).strip())
+        except ValueError:
+            raise ValueError("debe ser un número entero")
+        if not minimo <= numero <= maximo:
+            raise ValueError(f"debe estar entre {minimo} y {maximo}")
+        return str(numero)
+    return validar
+
+def _validar_texto(valor):
+    if not isinstance(valor, str):
+        raise ValueError("debe ser texto")
+    return valor
+
+def _validar_booleano(valor):
+    texto = str(valor).strip().lower()
+    if texto not in ('true', 'false'):
+        raise ValueError("debe ser true o false")
+    return texto
+
+def _validar_duraciones(valor):
+    try:
+        duraciones = json.loads(valor) if isinstance(valor, str) else valor
+        if not isinstance(duraciones, dict) or not all(
+                isinstance(v, int) and not isinstance(v, bool) and v > 0 for v in duraciones.values()):
+            raise ValueError
+    except ValueError:
+        raise ValueError('debe ser un JSON {"Servicio": minutos, ...}')
+    return json.dumps(duraciones, ensure_ascii=False)
+
+def _validar_dias_cerrados(valor):
+    try:
+        dias = json.loads(valor) if isinstance(valor, str) else valor
+        if not isinstance(dias, list):
+            raise ValueError
+        for dia in dias:
+            if isinstance(dia, int) and not isinstance(dia, bool):
+                if not 0 <= dia <= 6:
+                    raise ValueError
+            else:
+                datetime.date.fromisoformat(dia)
+    except (ValueError, TypeError):
+        raise ValueError('debe ser una lista JSON de días (0=Lunes) y/o fechas "YYYY-MM-DD"')
+    return json.dumps(dias)
+
+def _validar_contactos(valor):
+    try:
+        contactos = json.loads(valor) if isinstance(valor, str) else valor
+        if not isinstance(contactos, list) or not all(isinstance(c, str) for c in contactos):
+            raise ValueError
+    except ValueError:
+        raise ValueError('debe ser una lista JSON de nombres ["Nombre", ...]')
+    return json.dumps(contactos, ensure_ascii=False)
+
+# Claves de configuración conocidas: validan y normalizan el valor a texto
+# (las demás solo aceptan texto, ver _validar_texto)
+VALIDADORES_CONFIG = {
+    'nombre_negocio': _validar_texto,
+    'api_key': _validar_texto,
+    'instrucciones': _validar_texto,
+    'contactos_ignorados': _validar_contactos,
+    'bot_encendido': _validar_booleano,
+    'hora_inicio': _validar_entero(0, 23),
+    'hora_fin': _validar_entero(0, 23),
+    'intervalo_turnos': _validar_entero(5, 240),
+    'duraciones_servicio': _validar_duraciones,
+    'dias_cerrados': _validar_dias_cerrados,
+    'dias_retencion_mensajes': _validar_entero(1, 3650),
+}
+
+
+# Archivos cuyo esquema ya se verificó en este proceso
+_ESQUEMAS_LISTOS = set()
+_ESQUEMAS_LOCK = threading.Lock()
+
+def _clave_archivo(db_file):
+    """Identifica el archivo en disco (si se borra y se recrea, cambia la clave)"""
+    try:
+        info = os.stat(db_file)
+    except OSError:
+        return None
+    return (os.path.abspath(db_file), info.st_dev, info.st_ino)
+
+
+def verificar_respaldo(ruta):
+    """
+    Revisa un archivo de respaldo sin modificarlo: integridad, versión de
+    esquema y cantidad de filas. Retorna un dict con 'ok' y los detalles.
+    """
+    if not os.path.exists(ruta):
+        return {'ok': False, 'ruta': ruta, 'error': 'No existe el archivo'}
+    
+    conn = sqlite3.connect(ruta)
+    try:
+        integridad = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        tablas = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        filas = {
+            tabla: conn.execute(f'SELECT COUNT(*) FROM {tabla}').fetchone()[0]
+            for tabla in ('citas', 'clientes', 'conversaciones', 'mensajes', 'configuracion')
+            if tabla in tablas
+        }
+    except sqlite3.DatabaseError as e:
+        return {'ok': False, 'ruta': ruta, 'error': str(e)}
+    finally:
+        conn.close()
+    
+    ok = integridad == ['ok'] and 1 <= version <= VERSION_ESQUEMA and 'citas' in filas
+    resultado = {'ok': ok, 'ruta': ruta, 'version': version, 'filas': filas}
+    if not ok:
+        resultado['error'] = '; '.join(integridad) if integridad != ['ok'] else 'Esquema desconocido'
+    return resultado
+
+
+class Database:
+    def __init__(self, db_file=DATABASE_FILE):
+        self.db_file = db_file
+        self.pool = PoolConexiones(db_file)
         
-        # Tabla de mensajes (historial de cada conversación)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mensajes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conversacion_id INTEGER,
-                cliente_nombre TEXT,
-                es_bot INTEGER DEFAULT 0,
-                contenido TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (conversacion_id) REFERENCES conversaciones(id)
-            )
-        ''')
+        # Caché de configuración (se revalida contra config_version)
+        self._config = None
+        self._config_version = None
+        self._config_revisado = 0.0
+        self._config_lock = threading.Lock()
         
-        # Insertar configuración por defecto si no existe
-        cursor.execute('''
-            INSERT OR IGNORE INTO configuracion (clave, valor) VALUES
-            ('nombre_negocio', 'Barbería Z'),
-            ('api_key', ''),
-            ('bot_encendido', 'true'),
-            ('instrucciones', 'Horario: 9am-8pm. Corte $10. Barba $5. Corte+Barba $12.'),
-            ('contactos_ignorados', '[]'),
-            ('hora_inicio', '9'),
-            ('hora_fin', '20')
-        ''')
+        # Caché clave normalizada -> clientes.id (los ids no cambian salvo al
+        # restaurar un respaldo: se descarta cuando sube config_version)
+        self._clientes = {}
+        # Ids leídos o creados dentro de transaccion(): entran a la caché tras el COMMIT
+        self._transaccion_local = threading.local()
         
-        conn.commit()
-        conn.close()
-        print(f"[DB] Base de datos inicializada: {self.db_file}")
+        # Escritura diferida de mensajes (desactivada por defecto)
+        self.diario = None
+        
+        # Base de archivo: se abre solo cuando se archiva o se consulta
+        self.archivo_file = os.path.splitext(db_file)[0] + "_archivo.db"
+        self._pool_archivo = None
+        
+        # Hilo de respaldos programados (ver programar_respaldos)
+        self._respaldos = None
+        self._detener_respaldos = threading.Event()
+        
+        self.init_database()
+    
+    def get_connection(self):
+        """Obtiene una conexión nueva e independiente (quien la pide la cierra)"""
+        return self.pool.abrir()
+    
+    def conexion(self):
+        """Presta una conexión del pool: `with db.conexion() as conn: ...`"""
+        return self.pool.conexion()
+    
+    def activar_escritura_diferida(self, max_pendientes=DIARIO_MAX_PENDIENTES,
+                                   intervalo=DIARIO_INTERVALO_SEGUNDOS):
+        """
+        Activa el diario de mensajes: agregar_mensaje deja de escribir en
+        SQLite en el momento y los mensajes se vuelcan por lotes.
+        """
+        if self.diario is None:
+            self.diario = DiarioMensajes(self, max_pendientes, intervalo)
+            atexit.register(self.cerrar)
+        return self.diario
+    
+    def cerrar(self):
+        """Vuelca mensajes pendientes y cierra las conexiones abiertas del pool"""
+        if self.diario is not None:
+            self.diario.detener()
+            self.diario = None
+        if self._respaldos is not None:
+            self._detener_respaldos.set()
+            self._respaldos.join()
+            self._respaldos = None
+        if self._pool_archivo is not None:
+            self._pool_archivo.cerrar()
+        self.pool.cerrar()
+    
+    @contextlib.contextmanager
+    def transaccion(self):
+        """
+        Transacción de escritura: BEGIN IMMEDIATE toma el lock de escritura
+        al inicio (los demás escritores esperan en busy_timeout en vez de
+        fallar a mitad de camino). COMMIT al salir, ROLLBACK si hay excepción.
+        """
+        with self.conexion() as conn:
+            inicio = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            metricas.DB_ESPERA_LOCK.observar(time.perf_counter() - inicio)
+            clientes = self._transaccion_local.clientes = {}
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._transaccion_local.clientes = None
+            self._clientes.update(clientes)
+    
+    def init_database(self):
+        """
+        Deja el esquema al día. Se hace una sola vez por archivo y proceso;
+        si user_version ya es la última, solo cuesta una consulta.
+        """
+        clave = _clave_archivo(self.db_file)
+        if clave is not None and clave in _ESQUEMAS_LISTOS:
+            return
+        
+        with _ESQUEMAS_LOCK:
+            with self.conexion() as conn:
+                if self.version_esquema(conn) < VERSION_ESQUEMA:
+                    # WAL es persistente en el archivo: lectores y escritor no se bloquean
+                    conn.execute('PRAGMA journal_mode = WAL')
+                    self.migrar(conn)
+                    print(f"[DB] Base de datos inicializada: {self.db_file}")
+            clave = _clave_archivo(self.db_file)
+            if clave is not None:
+                _ESQUEMAS_LISTOS.add(clave)
+    
+    def version_esquema(self, conn):
+        """Versión de esquema aplicada en el archivo"""
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    def migrar(self, conn):
+        """Aplica en orden las migraciones pendientes, cada una en su transacción"""
+        if self.version_esquema(conn) >= VERSION_ESQUEMA:
+            return
+        
+        for version, descripcion, paso in MIGRACIONES:
+            # BEGIN IMMEDIATE: si el bot y el panel arrancan a la vez, solo uno migra
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.version_esquema(conn) >= version:
+                    conn.rollback()
+                    continue
+                
+                cursor = conn.cursor()
+                if callable(paso):
+                    paso(cursor)
+                else:
+                    for sentencia in paso:
+                        cursor.execute(sentencia)
+                cursor.execute(f'PRAGMA user_version = {version}')
+                conn.commit()
+                print(f"[DB] Migración {version} aplicada: {descripcion}")
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def verificar_planes(self):
+        """
+        Revisa con EXPLAIN QUERY PLAN las consultas críticas.
+        Lanza RuntimeError si alguna recorre una tabla completa (SCAN).
+        """
+        problemas = []
+        with self.conexion() as conn:
+            for nombre, (sql, params) in CONSULTAS_CRITICAS.items():
+                plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+                for fila in plan:
+                    detalle = fila['detail']
+                    if detalle.startswith('SCAN'):
+                        problemas.append(f"{nombre}: {detalle}")
+        
+        if problemas:
+            raise RuntimeError("Consultas sin índice:\n  " + "\n  ".join(problemas))
+        return True
+    
+    def versiones_datos(self):
+        """
+        Contador de cambios de cada tabla versionada y de la configuración.
+        Es una sola lectura de filas chicas: sirve para ETags sin consultar los datos.
+        """
+        with self.conexion() as conn:
+            rows = conn.execute('''
+                SELECT tabla, version FROM versiones_tablas
+                UNION ALL
+                SELECT 'configuracion', version FROM config_version WHERE id = 1
+            ''').fetchall()
+        return {row['tabla']: row['version'] for row in rows}
     
     # ==================== CONFIGURACIÓN ====================
     
+    def _config_cache(self):
+        """
+        Devuelve el diccionario de configuración en memoria.
+        Como mucho una vez por CONFIG_REVALIDAR_SEGUNDOS consulta config_version
+        y, solo si cambió, recarga toda la tabla en una consulta.
+        config_version también sube al restaurar un respaldo (en cualquier
+        proceso): si cambió, se descarta además la caché de clientes.
+        """
+        config = self._config
+        if config is not None and time.monotonic() - self._config_revisado < CONFIG_REVALIDAR_SEGUNDOS:
+            return config
+        
+        with self._config_lock:
+            with self.conexion() as conn:
+                version = conn.execute('SELECT version FROM config_version WHERE id = 1').fetchone()[0]
+                if self._config_version is not None and version != self._config_version:
+                    self._clientes.clear()
+                if self._config is None or version != self._config_version:
+                    rows = conn.execute('SELECT clave, valor FROM configuracion').fetchall()
+                    self._config = {row['clave']: row['valor'] for row in rows}
+                    self._config_version = version
+            self._config_revisado = time.monotonic()
+            return self._config
+    
+    def invalidar_config(self):
+        """Fuerza a recargar la configuración en la próxima lectura"""
+        self._config = None
+    
     def get_config(self, clave, default=None):
         """Obtiene un valor de configuración"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT valor FROM configuracion WHERE clave = ?', (clave,))
-        row = cursor.fetchone()
-        conn.close()
-        return row['valor'] if row else default
+        return self._config_cache().get(clave, default)
     
     def set_config(self, clave, valor):
         """Establece un valor de configuración"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO configuracion (clave, valor) VALUES (?, ?)
-        ''', (clave, valor))
-        conn.commit()
-        conn.close()
+        with self.transaccion() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO configuracion (clave, valor) VALUES (?, ?)
+            ''', (clave, valor))
+        self.invalidar_config()
     
     def get_all_config(self):
         """Obtiene toda la configuración como diccionario"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT clave, valor FROM configuracion')
-        rows = cursor.fetchall()
-        conn.close()
-        return {row['clave']: row['valor'] for row in rows}
+        return dict(self._config_cache())
+    
+    def set_config_many(self, valores):
+        """
+        Guarda varias claves en una sola transacción: el bot ve todos los
+        cambios juntos o ninguno, y config_version sube una sola vez.
+        Las claves conocidas se validan antes de escribir (VALIDADORES_CONFIG)
+        y las demás deben ser texto; lanza ValueError con todos los errores y sin guardar nada.
+        """
+        normalizados = {}
+        errores = []
+        for clave, valor in valores.items():
+            if valor is None:
+                errores.append(f"{clave}: falta el valor")
+                continue
+            try:
+                normalizados[clave] = VALIDADORES_CONFIG.get(clave, _validar_texto)(valor)
+            except ValueError as e:
+                errores.append(f"{clave}: {e}")
+        
+        if not errores and ('hora_inicio' in normalizados or 'hora_fin' in normalizados):
+            inicio = int(normalizados.get('hora_inicio', self.get_config('hora_inicio', 9)))
+            fin = int(normalizados.get('hora_fin', self.get_config('hora_fin', 20)))
+            if inicio >= fin:
+                errores.append("hora_inicio debe ser menor que hora_fin")
+        if errores:
+            raise ValueError("; ".join(errores))
+        if not normalizados:
+            return
+        
+        with self.transaccion() as conn:
+            version = conn.execute('SELECT version FROM config_version WHERE id = 1').fetchone()[0]
+            conn.executemany('''
+                INSERT OR REPLACE INTO configuracion (clave, valor) VALUES (?, ?)
+            ''', list(normalizados.items()))
+            # Los triggers suben la versión una vez por clave; queda en una sola subida
+            conn.execute('UPDATE config_version SET version = ? WHERE id = 1', (version + 1,))
+        self.invalidar_config()
     
     # ==================== CITAS ====================
     
     def obtener_citas_dia(self, fecha):
         """Obtiene todas las citas de un día"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM citas WHERE fecha = ? AND estado = 'Confirmado'
-            ORDER BY hora
-        ''', (fecha,))
-        rows = cursor.fetchall()
-        conn.close()
+        with self.conexion() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM citas WHERE fecha = ? AND estado = 'Confirmado'
+                ORDER BY hora
+            ''', (fecha,))
+            rows = cursor.fetchall()
         return [dict(row) for row in rows]
     
     def obtener_horarios_disponibles(self, fecha):
-        """Obtiene horarios libres para una fecha"""
-        hora_inicio = int(self.get_config('hora_inicio', 9))
-        hora_fin = int(self.get_config('hora_fin', 20))
+        """Obtiene horarios libres para una fecha (ValueError si no es una fecha válida)"""
+        fecha = datetime.date.fromisoformat(fecha).isoformat()
+        return self.obtener_disponibilidad(fecha, fecha)[fecha]
+    
+    def _reglas_horario(self):
+        """Lee de la configuración (en caché) las reglas de turnos"""
+        reglas = {
+            'apertura': int(self.get_config('hora_inicio', 9)) * 60,
+            'cierre': int(self.get_config('hora_fin', 20)) * 60,
+            'intervalo': int(self.get_config('intervalo_turnos', 60)),
+            'duraciones': {},
+            'cerrados': [],
+        }
+        try:
+            reglas['duraciones'] = {k: int(v) for k, v in json.loads(self.get_config('duraciones_servicio', '{}')).items()}
+        except (ValueError, TypeError, AttributeError):
+            pass
+        try:
+            reglas['cerrados'] = json.loads(self.get_config('dias_cerrados', '[]'))
+        except (ValueError, TypeError):
+            pass
+        return reglas
+    
+    def obtener_disponibilidad(self, desde, hasta=None, servicio=None, intervalo=None):
+        """
+        Horarios libres por día entre `desde` y `hasta` (inclusive), con una sola consulta.
+        - `intervalo`: minutos entre turnos; múltiplo de la config intervalo_turnos
+          (por defecto esa), así todo turno ofrecido se puede agendar
+        - `servicio`: el turno debe tener lugar para su duración completa
+          (sin servicio, la de SERVICIO_POR_DEFECTO, como en agendar_cita)
+        - Los días cerrados aparecen con lista vacía
+        Retorna {fecha: ["HH:MM", ...]}. Lanza ValueError si las fechas no son válidas.
+        """
+        _, libres = self._turnos_libres(desde, hasta, servicio, intervalo)
+        return {fecha: [_a_hora(m) for m in minutos] for fecha, minutos in libres.items()}
+    
+    def obtener_mapa_horarios(self, desde, hasta=None, servicio=None, intervalo=None):
+        """
+        Lo mismo que obtener_disponibilidad en formato compacto (un mes entra en ~1 KB):
+        {'inicio': 'HH:MM', 'intervalo': minutos, 'turnos': n, 'dias': {fecha: 'hex'}}
+        El bit i de cada día (el menos significativo es el 0) indica si está libre
+        el turno que empieza en inicio + i * intervalo.
+        """
+        grilla, libres = self._turnos_libres(desde, hasta, servicio, intervalo)
+        apertura, cierre, paso = grilla
+        dias = {}
+        for fecha, minutos in libres.items():
+            bits = 0
+            for m in minutos:
+                bits |= 1 << ((m - apertura) // paso)
+            dias[fecha] = format(bits, 'x')
+        return {
+            'inicio': _a_hora(apertura),
+            'intervalo': paso,
+            'turnos': max((cierre - apertura) // paso + 1, 0),
+            'dias': dias,
+        }
+    
+    def _turnos_libres(self, desde, hasta, servicio, intervalo):
+        """
+        Una pasada sobre las citas confirmadas del rango.
+        Retorna ((apertura, cierre, paso), {fecha: [minutos de inicio libres]}).
+        """
+        dia_desde = datetime.date.fromisoformat(desde)
+        dia_hasta = datetime.date.fromisoformat(hasta) if hasta else dia_desde
+        dias = (dia_hasta - dia_desde).days + 1
+        if dias < 1 or dias > MAX_DIAS_DISPONIBILIDAD:
+            raise ValueError(f"Rango inválido (1 a {MAX_DIAS_DISPONIBILIDAD} días)")
+        
+        reglas = self._reglas_horario()
+        paso = intervalo or reglas['intervalo']
+        if paso <= 0 or paso % reglas['intervalo']:
+            raise ValueError(f"El intervalo debe ser múltiplo de {reglas['intervalo']} minutos")
+        # Sin servicio, lo que ocuparía una cita nueva en agendar_cita
+        duracion = reglas['duraciones'].get(servicio or SERVICIO_POR_DEFECTO, reglas['intervalo'])
         
-        citas = self.obtener_citas_dia(fecha)
-        horas_ocupadas = [c['hora'] for c in citas]
+        with self.conexion() as conn:
+            rows = conn.execute('''
+                SELECT fecha, hora, servicio FROM citas
+                WHERE fecha BETWEEN ? AND ? AND estado = 'Confirmado'
+            ''', (dia_desde.isoformat(), dia_hasta.isoformat())).fetchall()
         
-        disponibles = []
-        for h in range(hora_inicio, hora_fin + 1):
-            hora_str = f"{h:02d}:00"
-            if hora_str not in horas_ocupadas:
-                disponibles.append(hora_str)
+        # Bloques ocupados por día: (inicio, fin) en minutos
+        ocupados = {}
+        for row in rows:
+            inicio = _a_minutos(row['hora'])
+            if inicio is None:
+                continue
+            fin = inicio + reglas['duraciones'].get(row['servicio'], reglas['intervalo'])
+            ocupados.setdefault(row['fecha'], []).append((inicio, fin))
         
-        return disponibles
+        libres = {}
+        for i in range(dias):
+            dia = dia_desde + datetime.timedelta(days=i)
+            fecha = dia.isoformat()
+            if dia.weekday() in reglas['cerrados'] or fecha in reglas['cerrados']:
+                libres[fecha] = []
+                continue
+            
+            bloques = ocupados.get(fecha, [])
+            libres[fecha] = [
+                m for m in range(reglas['apertura'], reglas['cierre'] + 1, paso)
+                if all(m + duracion <= inicio or m >= fin for inicio, fin in bloques)
+            ]
+        
+        return (reglas['apertura'], reglas['cierre'], paso), libres
     
-    def agendar_cita(self, fecha, hora, cliente_nombre, telefono="WhatsApp"):
+    def agendar_cita(self, fecha, hora, cliente_nombre, telefono="WhatsApp", servicio=None):
         """
         Agenda una cita.
         - Si el cliente ya tiene cita ese día, la reprograma
-        - Si el horario está ocupado por otro, retorna error
+        - El turno debe caer en la grilla (hora_inicio, hora_fin, intervalo_turnos)
+          y no pisarse con el turno de otro cliente según la duración de cada servicio
+        - Sin `servicio`, una reprogramación conserva el de la cita y una cita
+          nueva usa SERVICIO_POR_DEFECTO
+        
+        Verificación y escritura ocurren en una sola transacción; el índice
+        único idx_citas_turno_unico garantiza que no haya turnos dobles.
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        inicio = _a_minutos(hora)
+        try:
+            dia = datetime.date.fromisoformat(fecha)
+        except (TypeError, ValueError):
+            return False, "Fecha inválida"
         
-        # Verificar si el horario está ocupado por otro cliente
-        cursor.execute('''
-            SELECT * FROM citas 
-            WHERE fecha = ? AND hora = ? AND estado = 'Confirmado'
-        ''', (fecha, hora))
-        cita_existente = cursor.fetchone()
+        fecha = dia.isoformat()
         
-        if cita_existente:
-            if cita_existente['cliente_nombre'].lower() != cliente_nombre.lower():
-                conn.close()
-                return False, "Horario ocupado por otro cliente"
+        reglas = self._reglas_horario()
+        if dia.weekday() in reglas['cerrados'] or fecha in reglas['cerrados']:
+            return False, "Ese día no se atiende"
+        if (inicio is None or not reglas['apertura'] <= inicio <= reglas['cierre']
+                or (inicio - reglas['apertura']) % reglas['intervalo']):
+            return False, "Horario fuera de los turnos"
+        hora = _a_hora(inicio)
         
-        # Buscar si el cliente ya tiene cita ese día
-        cursor.execute('''
-            SELECT * FROM citas 
-            WHERE fecha = ? AND LOWER(cliente_nombre) = LOWER(?) AND estado = 'Confirmado'
-        ''', (fecha, cliente_nombre))
-        cita_cliente = cursor.fetchone()
-        
-        if cita_cliente:
-            # Reprogramar
-            old_hora = cita_cliente['hora']
-            cursor.execute('''
-                UPDATE citas SET hora = ? WHERE id = ?
-            ''', (hora, cita_cliente['id']))
-            conn.commit()
-            conn.close()
-            return True, f"Reprogramado de {old_hora} a {hora}"
-        else:
-            # Nueva cita
-            cursor.execute('''
-                INSERT INTO citas (cliente_nombre, fecha, hora, estado)
-                VALUES (?, ?, ?, 'Confirmado')
-            ''', (cliente_nombre, fecha, hora))
-            conn.commit()
-            conn.close()
-            return True, "Cita agendada"
+        try:
+            with self.transaccion() as conn:
+                cursor = conn.cursor()
+                cliente_id = self._cliente_id(cursor, cliente_nombre, telefono)
+                
+                # Turnos confirmados del día (el del propio cliente se va a mover)
+                cursor.execute('''
+                    SELECT id, hora, servicio, cliente_id FROM citas
+                    WHERE fecha = ? AND estado = 'Confirmado'
+                ''', (fecha,))
+                del_dia = cursor.fetchall()
+                cita_cliente = next((c for c in del_dia if c['cliente_id'] == cliente_id), None)
+                
+                servicio = servicio or (cita_cliente['servicio'] if cita_cliente else None) or SERVICIO_POR_DEFECTO
+                fin = inicio + reglas['duraciones'].get(servicio, reglas['intervalo'])
+                
+                # Verificar si el horario se pisa con el de otro cliente
+                for cita in del_dia:
+                    otro_inicio = _a_minutos(cita['hora'])
+                    if cita['cliente_id'] == cliente_id or otro_inicio is None:
+                        continue
+                    otro_fin = otro_inicio + reglas['duraciones'].get(cita['servicio'], reglas['intervalo'])
+                    if inicio < otro_fin and otro_inicio < fin:
+                        return False, "Horario ocupado por otro cliente"
+                
+                if cita_cliente:
+                    # Reprogramar
+                    old_hora = cita_cliente['hora']
+                    cursor.execute('''
+                        UPDATE citas SET hora = ?, servicio = ? WHERE id = ?
+                    ''', (hora, servicio, cita_cliente['id']))
+                    return True, f"Reprogramado de {old_hora} a {hora}"
+                else:
+                    # Nueva cita
+                    cursor.execute('''
+                        INSERT INTO citas (cliente_id, cliente_nombre, fecha, hora, servicio, estado)
+                        VALUES (?, ?, ?, ?, ?, 'Confirmado')
+                    ''', (cliente_id, cliente_nombre, fecha, hora, servicio))
+                    return True, "Cita agendada"
+        except sqlite3.IntegrityError:
+            # Otro proceso escribió el turno por fuera de esta transacción
+            return False, "Horario ocupado por otro cliente"
     
     def cancelar_cita(self, fecha, cliente_nombre):
         """Cancela una cita"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE citas SET estado = 'Cancelado'
-            WHERE fecha = ? AND LOWER(cliente_nombre) = LOWER(?) AND estado = 'Confirmado'
-        ''', (fecha, cliente_nombre))
-        affected = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with self.transaccion() as conn:
+            cursor = conn.cursor()
+            cliente_id = self._cliente_id(cursor, cliente_nombre, crear=False)
+            if cliente_id is None:
+                return False
+            cursor.execute('''
+                UPDATE citas SET estado = 'Cancelado'
+                WHERE fecha = ? AND cliente_id = ? AND estado = 'Confirmado'
+            ''', (fecha, cliente_id))
+            affected = cursor.rowcount
         return affected > 0
     
     def obtener_todas_citas(self, desde_fecha=None):
         """Obtiene todas las citas futuras"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.conexion() as conn:
+            cursor = conn.cursor()
+            
+            if desde_fecha:
+                cursor.execute('''
+                    SELECT * FROM citas WHERE fecha >= ? ORDER BY fecha, hora
+                ''', (desde_fecha,))
+            else:
+                cursor.execute('SELECT * FROM citas ORDER BY fecha DESC, hora')
+            
+            rows = cursor.fetchall()
+        return [dict(row) for row in rows]
+    
+    def obtener_citas_pagina(self, desde=None, hasta=None, estado=None, cursor=None, limite=CITAS_POR_PAGINA):
+        """
+        Página de citas ordenadas por (fecha, hora, id), con paginación keyset:
+        cada página continúa donde terminó la anterior sin OFFSET.
+        Retorna (citas, next_cursor); next_cursor es None en la última página.
+        """
+        limite = max(1, min(int(limite), MAX_CITAS_POR_PAGINA))
         
-        if desde_fecha:
-            cursor.execute('''
-                SELECT * FROM citas WHERE fecha >= ? ORDER BY fecha, hora
-            ''', (desde_fecha,))
-        else:
-            cursor.execute('SELECT * FROM citas ORDER BY fecha DESC, hora')
+        condiciones = []
+        params = []
+        if cursor:
+            condiciones.append('(fecha, hora, id) > (?, ?, ?)')
+            params.extend(_decodificar_cursor(cursor, 3))
+        elif desde:
+            condiciones.append('fecha >= ?')
+            params.append(desde)
+        if hasta:
+            condiciones.append('fecha <= ?')
+            params.append(hasta)
+        if estado:
+            condiciones.append('estado = ?')
+            params.append(estado)
         
-        rows = cursor.fetchall()
-        conn.close()
-        return [dict(row) for row in rows]
+        where = ('WHERE ' + ' AND '.join(condiciones)) if condiciones else ''
+        with self.conexion() as conn:
+            rows = conn.execute(f'''
+                SELECT * FROM citas {where}
+                ORDER BY fecha, hora, id
+                LIMIT ?
+            ''', params + [limite + 1]).fetchall()
+        
+        # Se pide una fila de más para saber si hay otra página
+        citas = [dict(row) for row in rows[:limite]]
+        next_cursor = None
+        if len(rows) > limite:
+            ultima = citas[-1]
+            next_cursor = _codificar_cursor(ultima['fecha'], ultima['hora'], ultima['id'])
+        return citas, next_cursor
     
     # ==================== CONVERSACIONES ====================
     
-    def obtener_conversacion(self, cliente_nombre):
-        """Obtiene o crea una conversación para un cliente"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+    def _cliente_id(self, cursor, cliente_nombre, telefono=None, crear=True):
+        """
+        id del cliente (creándolo si hace falta), con caché en memoria.
+        Solo se cachean ids confirmados: dentro de transaccion() esperan al
+        COMMIT, y en otra transacción abierta no se cachean (un ROLLBACK los borraría).
+        """
+        self._config_cache()  # Revalida la caché si otro proceso restauró un respaldo
+        clave = normalizar_nombre(cliente_nombre)
+        cliente_id = self._clientes.get(clave)
+        if cliente_id is None:
+            cliente_id = _buscar_o_crear_cliente(cursor, cliente_nombre, telefono, crear)
+            if cliente_id is not None:
+                pendientes = getattr(self._transaccion_local, 'clientes', None)
+                if pendientes is not None:
+                    pendientes[clave] = cliente_id
+                elif not cursor.connection.in_transaction:
+                    self._clientes[clave] = cliente_id
+        return cliente_id
+    
+    def _conversacion_activa(self, cursor, cliente_nombre):
+        """Busca o crea la conversación activa sin hacer commit (para usar dentro de una transacción)"""
+        cliente_id = self._cliente_id(cursor, cliente_nombre)
         cursor.execute('''
-            SELECT * FROM conversaciones WHERE cliente_nombre = ? AND estado = 'activa'
-        ''', (cliente_nombre,))
+            SELECT * FROM conversaciones WHERE cliente_id = ? AND estado = 'activa'
+        ''', (cliente_id,))
         conv = cursor.fetchone()
         
-        if not conv:
-            cursor.execute('''
-                INSERT INTO conversaciones (cliente_nombre, estado)
-                VALUES (?, 'activa')
-            ''', (cliente_nombre,))
-            conn.commit()
-            conv_id = cursor.lastrowid
-        else:
-            conv_id = conv['id']
+        if conv:
+            return conv['id'], cliente_id
         
-        conn.close()
+        cursor.execute('''
+            INSERT INTO conversaciones (cliente_id, cliente_nombre, estado)
+            VALUES (?, ?, 'activa')
+        ''', (cliente_id, cliente_nombre))
+        return cursor.lastrowid, cliente_id
+    
+    def obtener_conversacion(self, cliente_nombre):
+        """Obtiene o crea una conversación para un cliente"""
+        with self.transaccion() as conn:
+            conv_id, _ = self._conversacion_activa(conn.cursor(), cliente_nombre)
         return conv_id
     
     def agregar_mensaje(self, cliente_nombre, contenido, es_bot=False):
         """Agrega un mensaje al historial"""
-        conv_id = self.obtener_conversacion(cliente_nombre)
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO mensajes (conversacion_id, cliente_nombre, contenido, es_bot)
-            VALUES (?, ?, ?, ?)
-        ''', (conv_id, cliente_nombre, contenido, 1 if es_bot else 0))
-        
-        # Actualizar timestamp de última actividad
-        cursor.execute('''
-            UPDATE conversaciones SET ultimo_mensaje = CURRENT_TIMESTAMP WHERE id = ?
-        ''', (conv_id,))
+        if self.diario is not None:
+            self.diario.agregar(cliente_nombre, contenido, es_bot)
+            return
         
-        conn.commit()
-        conn.close()
+        with self.transaccion() as conn:
+            cursor = conn.cursor()
+            conv_id, cliente_id = self._conversacion_activa(cursor, cliente_nombre)
+            
+            cursor.execute('''
+                INSERT INTO mensajes (conversacion_id, cliente_id, cliente_nombre, contenido, es_bot)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (conv_id, cliente_id, cliente_nombre, contenido, 1 if es_bot else 0))
+            
+            # Actualizar timestamp de última actividad
+            cursor.execute('''
+                UPDATE conversaciones SET ultimo_mensaje = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (conv_id,))
     
     def obtener_historial(self, cliente_nombre, limite=10):
         """Obtiene el historial de mensajes de un cliente"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM mensajes 
-            WHERE cliente_nombre = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-        ''', (cliente_nombre, limite))
-        
-        rows = cursor.fetchall()
-        conn.close()
+        if self.diario is not None:
+            return self.diario.historial(cliente_nombre, limite)
+        return self._historial_db(cliente_nombre, limite)
+    
+    def _historial_db(self, cliente_nombre, limite):
+        """Últimos `limite` mensajes guardados, en orden cronológico"""
+        with self.conexion() as conn:
+            cursor = conn.cursor()
+            cliente_id = self._cliente_id(cursor, cliente_nombre, crear=False)
+            
+            cursor.execute('''
+                SELECT * FROM mensajes 
+                WHERE cliente_id = ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (cliente_id, limite))
+            
+            rows = cursor.fetchall()
         
         # Invertir para tener orden cronológico
         mensajes = [dict(row) for row in rows]
         mensajes.reverse()
+        
+        # Solo si la tabla activa no alcanza, completar con lo archivado
+        if len(mensajes) < limite:
+            mensajes = self._historial_archivo(cliente_nombre, limite - len(mensajes), mensajes) + mensajes
         return mensajes
     
+    def ultimo_mensaje_id(self):
+        """Id del último mensaje guardado (0 si no hay)"""
+        with self.conexion() as conn:
+            row = conn.execute('SELECT MAX(id) FROM mensajes').fetchone()
+        return row[0] or 0
+    
+    def obtener_mensajes_nuevos(self, despues_de_id, limite=100):
+        """Mensajes guardados con id mayor a `despues_de_id`, en orden de llegada"""
+        with self.conexion() as conn:
+            rows = conn.execute('''
+                SELECT id, cliente_nombre, es_bot, contenido, timestamp
+                FROM mensajes WHERE id > ?
+                ORDER BY id LIMIT ?
+            ''', (despues_de_id, limite)).fetchall()
+        return [dict(row) for row in rows]
+    
+    def obtener_bandeja(self, estado=None, cursor=None, limite=CONVERSACIONES_POR_PAGINA):
+        """
+        Bandeja de conversaciones (la más reciente primero), en una sola consulta:
+        cada una con su último mensaje, cuántos mensajes del cliente siguen sin
+        respuesta del bot (`sin_responder`) y si tiene cita confirmada.
+        Paginación keyset por (ultimo_mensaje, id). Retorna (conversaciones, next_cursor).
+        """
+        limite = max(1, min(int(limite), MAX_CONVERSACIONES_POR_PAGINA))
+        
+        condiciones = []
+        params = []
+        if estado:
+            condiciones.append('c.estado = ?')
+            params.append(estado)
+        if cursor:
+            condiciones.append('(c.ultimo_mensaje, c.id) < (?, ?)')
+            params.extend(_decodificar_cursor(cursor, 2))
+        
+        where = ('WHERE ' + ' AND '.join(condiciones)) if condiciones else ''
+        with self.conexion() as conn:
+            rows = conn.execute(f'''
+                WITH pagina AS (
+                    SELECT c.*,
+                        (SELECT MAX(id) FROM mensajes WHERE conversacion_id = c.id AND es_bot = 1) AS ultimo_bot_id,
+                        (SELECT MAX(id) FROM mensajes WHERE conversacion_id = c.id AND es_bot = 0) AS ultimo_cliente_id
+                    FROM conversaciones c {where}
+                    ORDER BY c.ultimo_mensaje DESC, c.id DESC
+                    LIMIT ?
+                )
+                SELECT p.*,
+                    m.contenido AS ultimo_contenido,
+                    m.es_bot AS ultimo_es_bot,
+                    m.timestamp AS ultimo_timestamp,
+                    (SELECT COUNT(*) FROM mensajes
+                     WHERE conversacion_id = p.id AND es_bot = 0 AND id > COALESCE(p.ultimo_bot_id, 0)) AS sin_responder
+                FROM pagina p
+                LEFT JOIN mensajes m ON m.id = MAX(COALESCE(p.ultimo_bot_id, 0), COALESCE(p.ultimo_cliente_id, 0))
+                ORDER BY p.ultimo_mensaje DESC, p.id DESC
+            ''', params + [limite + 1]).fetchall()
+        
+        # Se pide una fila de más para saber si hay otra página
+        conversaciones = []
+        for row in rows[:limite]:
+            conv = dict(row)
+            del conv['ultimo_bot_id'], conv['ultimo_cliente_id']
+            conv['cita_confirmada'] = bool(conv['cita_confirmada'])
+            conversaciones.append(conv)
+        next_cursor = None
+        if len(rows) > limite:
+            ultima = conversaciones[-1]
+            next_cursor = _codificar_cursor(ultima['ultimo_mensaje'], ultima['id'])
+        return conversaciones, next_cursor
+    
     def marcar_cita_confirmada(self, cliente_nombre):
         """Marca que la conversación terminó con cita confirmada"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE conversaciones 
-            SET cita_confirmada = 1, estado = 'cerrada'
-            WHERE cliente_nombre = ? AND estado = 'activa'
-        ''', (cliente_nombre,))
-        conn.commit()
-        conn.close()
+        with self.transaccion() as conn:
+            cursor = conn.cursor()
+            cliente_id = self._cliente_id(cursor, cliente_nombre, crear=False)
+            cursor.execute('''
+                UPDATE conversaciones 
+                SET cita_confirmada = 1, estado = 'cerrada'
+                WHERE cliente_id = ? AND estado = 'activa'
+            ''', (cliente_id,))
     
     def conversacion_tiene_cita(self, cliente_nombre):
         """Verifica si el cliente ya confirmó cita en esta conversación"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT cita_confirmada FROM conversaciones 
-            WHERE cliente_nombre = ? AND estado = 'activa'
-        ''', (cliente_nombre,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.conexion() as conn:
+            cursor = conn.cursor()
+            cliente_id = self._cliente_id(cursor, cliente_nombre, crear=False)
+            cursor.execute('''
+                SELECT cita_confirmada FROM conversaciones 
+                WHERE cliente_id = ? AND estado = 'activa'
+            ''', (cliente_id,))
+            row = cursor.fetchone()
         return row and row['cita_confirmada'] == 1
     
     # ==================== ESTADÍSTICAS ====================
     
     def obtener_estadisticas(self):
-        """Obtiene estadísticas del bot"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        """Obtiene estadísticas del bot (lecturas puntuales de los contadores)"""
         hoy = datetime.date.today().isoformat()
         
-        # Citas de hoy
-        cursor.execute('''
-            SELECT COUNT(*) as total FROM citas 
-            WHERE fecha = ? AND estado = 'Confirmado'
-        ''', (hoy,))
-        citas_hoy = cursor.fetchone()['total']
+        with self.conexion() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT
+                    (SELECT citas_confirmadas FROM estadisticas_diarias WHERE fecha = ?) as citas_hoy,
+                    (SELECT mensajes FROM estadisticas_diarias WHERE fecha = ?) as mensajes_hoy,
+                    (SELECT valor FROM contadores WHERE clave = 'conversaciones_activas') as conv_activas
+            ''', (hoy, hoy))
+            row = cursor.fetchone()
         
-        # Total mensajes hoy
-        cursor.execute('''
-            SELECT COUNT(*) as total FROM mensajes 
-            WHERE DATE(timestamp) = ?
-        ''', (hoy,))
-        mensajes_hoy = cursor.fetchone()['total']
+        return {
+            'citas_hoy': row['citas_hoy'] or 0,
+            'mensajes_hoy': row['mensajes_hoy'] or 0,
+            'conversaciones_activas': row['conv_activas'] or 0
+        }
+    
+    def obtener_panel(self, fecha):
+        """
+        Todo lo que muestra la página del panel, con una sola conexión y una
+        lectura consistente: configuración, estadísticas, citas y horarios
+        libres de `fecha`, y las versiones de datos con que se armó.
+        """
+        with self.conexion() as conn:
+            # Los métodos de abajo reusan esta conexión (el pool es reentrante)
+            conn.execute('BEGIN')
+            try:
+                return {
+                    'config': self.get_all_config(),
+                    'stats': self.obtener_estadisticas(),
+                    'citas': self.obtener_citas_dia(fecha),
+                    'horarios': self.obtener_horarios_disponibles(fecha),
+                    'versiones': self.versiones_datos(),
+                }
+            finally:
+                conn.rollback()  # Solo lectura
+    
+    def obtener_serie_diaria(self, dias=30, hasta=None):
+        """
+        Serie histórica por día (más antiguo primero), con ceros en días sin actividad:
+        [{'fecha', 'mensajes', 'citas_confirmadas', 'citas_agendadas'}, ...]
+        """
+        dia_hasta = datetime.date.fromisoformat(hasta) if hasta else datetime.date.today()
+        dia_desde = dia_hasta - datetime.timedelta(days=dias - 1)
         
-        # Conversaciones activas
-        cursor.execute('''
-            SELECT COUNT(*) as total FROM conversaciones WHERE estado = 'activa'
-        ''')
-        conv_activas = cursor.fetchone()['total']
+        with self.conexion() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM estadisticas_diarias WHERE fecha BETWEEN ? AND ?
+            ''', (dia_desde.isoformat(), dia_hasta.isoformat()))
+            por_fecha = {row['fecha']: dict(row) for row in cursor.fetchall()}
         
-        conn.close()
+        serie = []
+        for i in range(dias):
+            fecha = (dia_desde + datetime.timedelta(days=i)).isoformat()
+            serie.append(por_fecha.get(fecha, {
+                'fecha': fecha, 'mensajes': 0, 'citas_confirmadas': 0, 'citas_agendadas': 0
+            }))
+        return serie
+    
+    def reconstruir_estadisticas(self):
+        """Backfill: recalcula los contadores a partir de las tablas (incluye mensajes archivados)"""
+        archivados = []
+        archivo = self._archivo()
+        if archivo is not None:
+            with archivo.conexion() as aconn:
+                archivados = aconn.execute('''
+                    SELECT DATE(timestamp), COUNT(*) FROM mensajes GROUP BY DATE(timestamp)
+                ''').fetchall()
         
-        return {
-            'citas_hoy': citas_hoy,
-            'mensajes_hoy': mensajes_hoy,
-            'conversaciones_activas': conv_activas
-        }
+        with self.transaccion() as conn:
+            cursor = conn.cursor()
+            _reconstruir_estadisticas(cursor)
+            cursor.executemany('''
+                INSERT INTO estadisticas_diarias (fecha, mensajes) VALUES (?, ?)
+                ON CONFLICT (fecha) DO UPDATE SET mensajes = mensajes + excluded.mensajes
+            ''', [tuple(row) for row in archivados])
+    
+    # ==================== BÚSQUEDA ====================
+    
+    def busqueda_indexada(self):
+        """True si existe el índice FTS5 de mensajes"""
+        with self.conexion() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'mensajes_fts'"
+            ).fetchone()
+        return row is not None
+    
+    def buscar_mensajes(self, texto, desde=None, hasta=None, cliente_nombre=None, limite=20):
+        """
+        Busca mensajes por contenido, los más relevantes primero (bm25).
+        - `desde`/`hasta`: fechas YYYY-MM-DD inclusive
+        - Cada resultado trae `fragmento` con las coincidencias entre [ ]
+        """
+        consulta = _consulta_fts(texto)
+        if consulta is None:
+            return []
+        limite = max(1, int(limite))  # LIMIT negativo en SQLite = sin límite
+        
+        condiciones = []
+        params = []
+        if desde:
+            condiciones.append('m.timestamp >= ?')
+            params.append(datetime.date.fromisoformat(desde).isoformat())
+        if hasta:
+            condiciones.append('m.timestamp < ?')
+            params.append((datetime.date.fromisoformat(hasta) + datetime.timedelta(days=1)).isoformat())
+        if cliente_nombre:
+            condiciones.append('m.cliente_id = (SELECT id FROM clientes WHERE clave = ?)')
+            params.append(normalizar_nombre(cliente_nombre))
+        filtros = ''.join(f' AND {c}' for c in condiciones)
+        
+        with self.conexion() as conn:
+            if self.busqueda_indexada():
+                rows = conn.execute(f'''
+                    SELECT m.*, snippet(mensajes_fts, 0, '[', ']', '…', 12) AS fragmento,
+                           bm25(mensajes_fts) AS puntaje
+                    FROM mensajes_fts
+                    JOIN mensajes m ON m.id = mensajes_fts.rowid
+                    WHERE mensajes_fts MATCH ?{filtros}
+                    ORDER BY puntaje
+                    LIMIT ?
+                ''', [consulta] + params + [limite]).fetchall()
+            else:
+                # Respaldo sin FTS5: alguna palabra con LIKE, más recientes primero
+                palabras = re.findall(r'\w+', texto)
+                likes = ' OR '.join('m.contenido LIKE ?' for _ in palabras)
+                rows = conn.execute(f'''
+                    SELECT m.*, m.contenido AS fragmento, 0 AS puntaje
+                    FROM mensajes m
+                    WHERE ({likes}){filtros}
+                    ORDER BY m.timestamp DESC
+                    LIMIT ?
+                ''', [f'%{p}%' for p in palabras] + params + [limite]).fetchall()
+        return [dict(row) for row in rows]
+    
+    # ==================== ARCHIVO ====================
+    
+    def _archivo(self, crear=False):
+        """Pool de la base de archivo (None si todavía no existe y no se pide crearla)"""
+        if self._pool_archivo is None:
+            if not crear and not os.path.exists(self.archivo_file):
+                return None
+            pool = PoolConexiones(self.archivo_file)
+            with pool.conexion() as conn:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.executescript(ESQUEMA_ARCHIVO)
+                _migrar_archivo(conn)
+            self._pool_archivo = pool
+        return self._pool_archivo
+    
+    def _historial_archivo(self, cliente_nombre, faltan, recientes):
+        """Hasta `faltan` mensajes archivados del cliente, en orden cronológico"""
+        archivo = self._archivo()
+        if archivo is None:
+            return []
+        
+        with archivo.conexion() as conn:
+            rows = conn.execute('''
+                SELECT id, conversacion_id, cliente_nombre, es_bot, contenido, timestamp FROM mensajes
+                WHERE cliente_clave = ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (normalizar_nombre(cliente_nombre), faltan + len(recientes))).fetchall()
+        
+        # Un lote interrumpido puede dejar un mensaje en ambas bases
+        ids = {m['id'] for m in recientes}
+        antiguos = [dict(row) for row in rows if row['id'] not in ids][:faltan]
+        antiguos.reverse()
+        return antiguos
+    
+    def archivar_mensajes(self, dias=None, lote=ARCHIVO_LOTE, pausa=ARCHIVO_PAUSA_SEGUNDOS):
+        """
+        Mueve a la base de archivo los mensajes con más de `dias` días
+        (por defecto la config dias_retencion_mensajes) y luego las
+        conversaciones cerradas que quedaron sin mensajes.
+        Trabaja por lotes: copia al archivo, confirma y recién entonces borra
+        de la base activa, así que se puede interrumpir y volver a correr.
+        Retorna {'mensajes': n, 'conversaciones': n}.
+        """
+        if dias is None:
+            dias = int(self.get_config('dias_retencion_mensajes', 90))
+        corte = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=dias)).strftime('%Y-%m-%d %H:%M:%S')
+        archivo = self._archivo(crear=True)
+        movidos = {'mensajes': 0, 'conversaciones': 0}
+        
+        while True:
+            with self.conexion() as conn:
+                rows = conn.execute('''
+                    SELECT id, conversacion_id, cliente_nombre, es_bot, contenido, timestamp
+                    FROM mensajes WHERE timestamp < ?
+                    ORDER BY timestamp LIMIT ?
+                ''', (corte, lote)).fetchall()
+            if not rows:
+                break
+            
+            with archivo.conexion() as aconn:
+                aconn.executemany('''
+                    INSERT OR IGNORE INTO mensajes (id, conversacion_id, cliente_nombre, es_bot, contenido, timestamp, cliente_clave)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [tuple(row) + (normalizar_nombre(row['cliente_nombre']),) for row in rows])
+                aconn.commit()
+            
+            with self.transaccion() as conn:
+                conn.executemany('DELETE FROM mensajes WHERE id = ?', [(row['id'],) for row in rows])
+            movidos['mensajes'] += len(rows)
+            time.sleep(pausa)
+        
+        while True:
+            with self.conexion() as conn:
+                rows = conn.execute('''
+                    SELECT id, cliente_nombre, estado, ultimo_mensaje, cita_confirmada
+                    FROM conversaciones c
+                    WHERE estado <> 'activa' AND ultimo_mensaje < ?
+                      AND NOT EXISTS (SELECT 1 FROM mensajes m WHERE m.conversacion_id = c.id)
+                    LIMIT ?
+                ''', (corte, lote)).fetchall()
+            if not rows:
+                break
+            
+            with archivo.conexion() as aconn:
+                aconn.executemany('''
+                    INSERT OR IGNORE INTO conversaciones (id, cliente_nombre, estado, ultimo_mensaje, cita_confirmada, cliente_clave)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [tuple(row) + (normalizar_nombre(row['cliente_nombre']),) for row in rows])
+                aconn.commit()
+            
+            with self.transaccion() as conn:
+                conn.executemany('DELETE FROM conversaciones WHERE id = ?', [(row['id'],) for row in rows])
+            movidos['conversaciones'] += len(rows)
+            time.sleep(pausa)
+        
+        return movidos
+    
+    def obtener_conversaciones_archivadas(self, cliente_nombre, limite=10):
+        """Conversaciones archivadas de un cliente (más reciente primero), cada una con sus mensajes"""
+        archivo = self._archivo()
+        if archivo is None:
+            return []
+        
+        with archivo.conexion() as conn:
+            convs = [dict(row) for row in conn.execute('''
+                SELECT id, cliente_nombre, estado, ultimo_mensaje, cita_confirmada FROM conversaciones
+                WHERE cliente_clave = ?
+                ORDER BY ultimo_mensaje DESC LIMIT ?
+            ''', (normalizar_nombre(cliente_nombre), limite))]
+            for conv in convs:
+                conv['mensajes'] = [dict(row) for row in conn.execute('''
+                    SELECT id, conversacion_id, cliente_nombre, es_bot, contenido, timestamp FROM mensajes
+                    WHERE conversacion_id = ? ORDER BY timestamp, id
+                ''', (conv['id'],))]
+        return convs
+    
+    # ==================== EXPORTACIÓN ====================
+    
+    def iterar_citas(self, desde=None, hasta=None, estado=None, lote=EXPORTAR_LOTE):
+        """Genera todas las citas del rango ordenadas por (fecha, hora, id), de a `lote` por consulta"""
+        cursor = None
+        while True:
+            citas, cursor = self.obtener_citas_pagina(desde, hasta, estado, cursor, lote)
+            yield from citas
+            if cursor is None:
+                return
+    
+    def iterar_mensajes(self, desde=None, hasta=None, cliente_nombre=None, incluir_archivo=True, lote=EXPORTAR_LOTE):
+        """
+        Genera los mensajes del rango (fechas YYYY-MM-DD, inclusive) ordenados
+        por (timestamp, id), de a `lote` por consulta. Con `incluir_archivo`
+        también recorre la base de archivo, intercalada en orden y sin repetir.
+        """
+        hasta_exclusivo = None
+        if hasta:
+            hasta_exclusivo = (datetime.date.fromisoformat(hasta) + datetime.timedelta(days=1)).isoformat()
+        if desde:
+            datetime.date.fromisoformat(desde)  # ValueError antes de empezar
+        
+        # El cliente se busca por su clave normalizada en las dos bases
+        clave = normalizar_nombre(cliente_nombre) if cliente_nombre else None
+        activos = self._iterar_mensajes(
+            self.pool, 'cliente_id = (SELECT id FROM clientes WHERE clave = ?)', clave, desde, hasta_exclusivo, lote)
+        archivo = self._archivo() if incluir_archivo else None
+        if archivo is None:
+            yield from activos
+            return
+        
+        archivados = self._iterar_mensajes(archivo, 'cliente_clave = ?', clave, desde, hasta_exclusivo, lote)
+        ultimo = None
+        for mensaje in heapq.merge(archivados, activos, key=lambda m: (m['timestamp'], m['id'])):
+            # Un lote de archivo interrumpido puede dejar el mismo mensaje en ambas bases
+            if mensaje['id'] != ultimo:
+                yield mensaje
+            ultimo = mensaje['id']
+    
+    def _iterar_mensajes(self, pool, filtro_cliente, clave, desde, hasta_exclusivo, lote):
+        """
+        Paginación keyset por (timestamp, id) sobre la base del `pool` dado.
+        `filtro_cliente` es la condición (con un ?) que se aplica si hay `clave`.
+        """
+        condiciones = []
+        params = []
+        if desde:
+            condiciones.append('timestamp >= ?')
+            params.append(desde)
+        if hasta_exclusivo:
+            condiciones.append('timestamp < ?')
+            params.append(hasta_exclusivo)
+        if clave:
+            condiciones.append(filtro_cliente)
+            params.append(clave)
+        
+        ultima = None
+        while True:
+            where = list(condiciones)
+            if ultima:
+                where.append('(timestamp, id) > (?, ?)')
+            with pool.conexion() as conn:
+                rows = conn.execute(f'''
+                    SELECT id, conversacion_id, cliente_nombre, es_bot, contenido, timestamp
+                    FROM mensajes {('WHERE ' + ' AND '.join(where)) if where else ''}
+                    ORDER BY timestamp, id
+                    LIMIT ?
+                ''', params + list(ultima or ()) + [lote]).fetchall()
+            yield from (dict(row) for row in rows)
+            if len(rows) < lote:
+                return
+            ultima = (rows[-1]['timestamp'], rows[-1]['id'])
+    
+    # ==================== RESPALDOS ====================
+    
+    def respaldar(self, directorio=RESPALDO_DIR, conservar=RESPALDOS_CONSERVAR,
+                  paginas=RESPALDO_PAGINAS, pausa=RESPALDO_PAUSA_SEGUNDOS, etiqueta=None):
+        """
+        Copia la base en caliente con la API de backup de SQLite, de a
+        `paginas` páginas por paso. Se escribe a un .tmp, se verifica y
+        recién entonces toma su nombre definitivo (único: nunca pisa otro
+        respaldo). Luego deja solo los `conservar` respaldos más recientes
+        (None = no borra ninguno). Con `etiqueta` el nombre queda fuera de
+        listar_respaldos y de la rotación.
+        Retorna la ruta del respaldo.
+        """
+        if self.diario is not None:
+            self.diario.volcar()
+        
+        os.makedirs(directorio, exist_ok=True)
+        base = os.path.splitext(os.path.basename(self.db_file))[0]
+        nombre = f"{base}_{etiqueta}" if etiqueta else base
+        marca = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        destino = os.path.join(directorio, f"{nombre}_{marca}.db")
+        n = 0
+        while os.path.exists(destino) or os.path.exists(destino + ".tmp"):
+            n += 1
+            destino = os.path.join(directorio, f"{nombre}_{marca}_{n}.db")
+        temporal = destino + ".tmp"
+        
+        origen = self.pool.abrir()
+        copia = sqlite3.connect(temporal)
+        try:
+            # Transacción de lectura abierta: la copia ve una foto fija (WAL)
+            # y no vuelve a empezar aunque el bot escriba entre pasos
+            origen.execute('BEGIN')
+            origen.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone()
+            origen.backup(copia, pages=paginas, sleep=pausa)
+            origen.rollback()
+            # El respaldo es un archivo suelto: sin -wal ni -shm
+            copia.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            copia.close()
+            origen.close()
+        
+        verificacion = verificar_respaldo(temporal)
+        if not verificacion['ok']:
+            os.remove(temporal)
+            raise RuntimeError(f"Respaldo inválido: {verificacion['error']}")
+        os.replace(temporal, destino)
+        
+        if conservar is not None:
+            self._rotar_respaldos(directorio, base, conservar)
+        return destino
+    
+    def listar_respaldos(self, directorio=RESPALDO_DIR):
+        """Rutas de los respaldos de esta base, del más reciente al más viejo"""
+        if not os.path.isdir(directorio):
+            return []
+        base = os.path.splitext(os.path.basename(self.db_file))[0]
+        patron = re.compile(re.escape(base) + r'_\d{8}_\d{6}(?:_\d+)*\.db$')
+        nombres = sorted((n for n in os.listdir(directorio) if patron.match(n)), reverse=True)
+        return [os.path.join(directorio, n) for n in nombres]
+    
+    def _rotar_respaldos(self, directorio, base, conservar):
+        """Borra los respaldos más viejos que excedan `conservar`"""
+        for ruta in self.listar_respaldos(directorio)[conservar:]:
+            try:
+                os.remove(ruta)
+            except OSError as e:
+                print(f"[DB] No se pudo borrar el respaldo {ruta}: {e}")
+    
+    def programar_respaldos(self, cada_horas=24, directorio=RESPALDO_DIR, conservar=RESPALDOS_CONSERVAR):
+        """Hace un respaldo cada `cada_horas` horas en un hilo de fondo (hasta cerrar())"""
+        if self._respaldos is not None:
+            return
+        
+        def bucle():
+            while not self._detener_respaldos.wait(cada_horas * 3600):
+                try:
+                    print(f"[DB] Respaldo creado: {self.respaldar(directorio, conservar)}")
+                except Exception as e:
+                    print(f"[DB] Error en respaldo programado: {e}")
+        
+        self._detener_respaldos.clear()
+        self._respaldos = threading.Thread(target=bucle, name="respaldos", daemon=True)
+        self._respaldos.start()
+        atexit.register(self.cerrar)
+    
+    def restaurar_respaldo(self, ruta, directorio=RESPALDO_DIR):
+        """
+        Reemplaza el contenido de la base por el de un respaldo verificado.
+        Antes guarda un respaldo del estado actual con la etiqueta
+        "antes_restaurar" (no entra en la rotación; se borra a mano).
+        La copia se hace en un solo paso con el lock de escritura tomado, así
+        el bot y el panel pasan directo del estado anterior al restaurado.
+        Retorna la ruta del respaldo previo.
+        """
+        verificacion = verificar_respaldo(ruta)
+        if not verificacion['ok']:
+            raise RuntimeError(f"Respaldo inválido: {verificacion['error']}")
+        
+        previo = self.respaldar(directorio, conservar=None, etiqueta='antes_restaurar')
+        
+        origen = sqlite3.connect(ruta)
+        try:
+            with self.conexion() as conn:
+                version_config = conn.execute('SELECT version FROM config_version WHERE id = 1').fetchone()[0]
+                versiones = [
+                    (row['version'], row['tabla'])
+                    for row in conn.execute('SELECT tabla, version FROM versiones_tablas')
+                ]
+                origen.backup(conn)
+                # Un respaldo viejo se pone al día con las migraciones pendientes
+                self.migrar(conn)
+                # Los contadores del respaldo son más viejos: quedan por encima de
+                # los de antes de restaurar, así ningún ETag ya entregado se repite
+                conn.executemany('''
+                    UPDATE versiones_tablas SET version = MAX(version, ?) + 1 WHERE tabla = ?
+                ''', versiones)
+                # Los demás procesos recargan su caché de configuración y de clientes
+                # (en su próxima revalidación, a lo sumo CONFIG_REVALIDAR_SEGUNDOS)
+                conn.execute('''
+                    UPDATE config_version SET version = MAX(version, ?) + 1 WHERE id = 1
+                ''', (version_config,))
+                conn.commit()
+        finally:
+            origen.close()
+        
+        self.invalidar_config()
+        self._clientes.clear()
+        return previo
+
+
+# Latencia, filas y errores de cada método público (ver metricas.py)
+metricas.instrumentar(Database, excluir=(
+    'get_connection', 'conexion', 'transaccion', 'activar_escritura_diferida',
+    'cerrar', 'init_database', 'version_esquema', 'migrar', 'programar_respaldos',
+))
+
+
+class DatabasePerezosa:
+    """
+    Proxy de la instancia global: importar este módulo no abre la base ni
+    imprime nada; la Database real se crea en el primer uso de `db`.
+    """
+    
+    def __init__(self, db_file=DATABASE_FILE):
+        self._db_file = db_file
+        self._instancia = None
+        self._lock = threading.Lock()
+    
+    def _obtener(self):
+        if self._instancia is None:
+            with self._lock:
+                if self._instancia is None:
+                    self._instancia = Database(self._db_file)
+        return self._instancia
+    
+    def __getattr__(self, nombre):
+        return getattr(self._obtener(), nombre)
 
 
-# Instancia global
-db = Database()
+# Instancia global (perezosa)
+db = DatabasePerezosa()
 
 
 # Para retrocompatibilidad con agenda_helper
@@ -376,9 +2132,9 @@ def obtener_horarios_disponibles(fecha):
     """Compatibilidad con código anterior"""
     return db.obtener_horarios_disponibles(fecha)
 
-def agendar_cita(fecha, hora, cliente, telefono):
+def agendar_cita(fecha, hora, cliente, telefono, servicio=None):
     """Compatibilidad con código anterior"""
-    return db.agendar_cita(fecha, hora, cliente, telefono)
+    return db.agendar_cita(fecha, hora, cliente, telefono, servicio)
 
 def cancelar_cita(fecha, cliente):
     """Compatibilidad con código anterior"""
@@ -386,6 +2142,49 @@ def cancelar_cita(fecha, cliente):
 
 
 if __name__ == "__main__":
+    # python database.py reconstruir_estadisticas
+    if len(sys.argv) > 1 and sys.argv[1] == 'reconstruir_estadisticas':
+        db.reconstruir_estadisticas()
+        print(f"[OK] Estadísticas recalculadas: {db.obtener_estadisticas()}")
+        sys.exit(0)
+    
+    # python database.py archivar [DIAS]  (programar a diario con cron / Programador de tareas)
+    if len(sys.argv) > 1 and sys.argv[1] == 'archivar':
+        dias = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        movidos = db.archivar_mensajes(dias)
+        print(f"[OK] Archivados {movidos['mensajes']} mensajes y {movidos['conversaciones']} conversaciones en {db.archivo_file}")
+        sys.exit(0)
+    
+    # python database.py respaldar [DIR]  (programar con cron / Programador de tareas)
+    if len(sys.argv) > 1 and sys.argv[1] == 'respaldar':
+        directorio = sys.argv[2] if len(sys.argv) > 2 else RESPALDO_DIR
+        print(f"[OK] Respaldo creado: {db.respaldar(directorio)}")
+        sys.exit(0)
+    
+    # python database.py respaldar_cada HORAS [DIR]  (queda corriendo)
+    if len(sys.argv) > 2 and sys.argv[1] == 'respaldar_cada':
+        directorio = sys.argv[3] if len(sys.argv) > 3 else RESPALDO_DIR
+        print(f"[OK] Respaldo creado: {db.respaldar(directorio)}")
+        db.programar_respaldos(float(sys.argv[2]), directorio)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            db.cerrar()
+        sys.exit(0)
+    
+    # python database.py verificar_respaldo RUTA
+    if len(sys.argv) > 2 and sys.argv[1] == 'verificar_respaldo':
+        resultado = verificar_respaldo(sys.argv[2])
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+        sys.exit(0 if resultado['ok'] else 1)
+    
+    # python database.py restaurar RUTA
+    if len(sys.argv) > 2 and sys.argv[1] == 'restaurar':
+        previo = db.restaurar_respaldo(sys.argv[2])
+        print(f"[OK] Base restaurada desde {sys.argv[2]} (estado anterior guardado en {previo})")
+        sys.exit(0)
+    
     # Test de la base de datos
     print("=== Test de Base de Datos ===")
     
@@ -398,3 +2197,9 @@ if __name__ == "__main__":
     
     # Estadísticas
     print(f"Estadísticas: {db.obtener_estadisticas()}")
+    
+    # Planes de consulta
+    with db.conexion() as conn:
+        print(f"Versión de esquema: {db.version_esquema(conn)}")
+    db.verificar_planes()
+    print("Planes de consulta: OK (sin SCAN en consultas críticas)")
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+FACHADA ASYNC PARA LA BASE DE DATOS
+===================================
+Versión awaitable de la API de `Database` para un bot o servidor asyncio:
+
+    from database_async import DatabaseAsync
+
+    adb = DatabaseAsync()
+    nombre = await adb.get_config('nombre_negocio')
+    exito, mensaje = await adb.agendar_cita(fecha, hora, cliente)
+
+- Las lecturas corren en un pool acotado de hilos lectores
+- Las escrituras corren en un único hilo escritor (serializadas en el proceso)
+- El event loop nunca queda bloqueado esperando a SQLite
+La API síncrona (`from database import db`) sigue igual para los scripts.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from database import Database, db
+
+# Hilos lectores (WAL permite leer en paralelo con el escritor)
+LECTORES = 4
+
+# Métodos de Database según el hilo donde se ejecutan
+METODOS_LECTURA = {
+    'get_config',
+    'get_all_config',
+    'obtener_citas_dia',
+    'obtener_horarios_disponibles',
+    'obtener_disponibilidad',
+    'obtener_mapa_horarios',
+    'obtener_todas_citas',
+    'obtener_citas_pagina',
+    'obtener_historial',
+    'ultimo_mensaje_id',
+    'obtener_mensajes_nuevos',
+    'conversacion_tiene_cita',
+    'obtener_bandeja',
+    'obtener_estadisticas',
+    'obtener_panel',
+    'obtener_serie_diaria',
+    'buscar_mensajes',
+    'obtener_conversaciones_archivadas',
+    'verificar_planes',
+    'versiones_datos',
+    'listar_respaldos',
+}
+
+METODOS_ESCRITURA = {
+    'set_config',
+    'set_config_many',
+    'agendar_cita',
+    'cancelar_cita',
+    'obtener_conversacion',  # crea la conversación si no existe
+    'agregar_mensaje',
+    'marcar_cita_confirmada',
+    'reconstruir_estadisticas',
+    'archivar_mensajes',
+    'respaldar',  # antes de copiar vuelca el diario de mensajes (escritura diferida)
+    'restaurar_respaldo',
+}
+
+
+class DatabaseAsync:
+    """Envuelve una instancia de Database y expone sus métodos como corutinas"""
+
+    def __init__(self, database=None, lectores=LECTORES):
+        # La instancia global es perezosa: se crea (y migra) en el primer
+        # método, que ya corre en un hilo del executor y no en el event loop
+        self.database = db if database is None else database
+        self._escritor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-escritor")
+        self._lectores = ThreadPoolExecutor(max_workers=lectores, thread_name_prefix="db-lector")
+
+    def __getattr__(self, nombre):
+        """adb.metodo(...) -> corutina que ejecuta db.metodo(...) en el hilo que corresponde"""
+        if nombre in METODOS_ESCRITURA:
+            executor = self._escritor
+        elif nombre in METODOS_LECTURA:
+            executor = self._lectores
+        else:
+            raise AttributeError(f"DatabaseAsync no expone '{nombre}'")
+
+        async def llamada(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(self._ejecutar, nombre, args, kwargs))
+
+        llamada.__name__ = nombre
+        llamada.__doc__ = getattr(Database, nombre).__doc__
+        return llamada
+
+    def _ejecutar(self, nombre, args, kwargs):
+        """Resuelve y llama al método en el hilo del executor"""
+        return getattr(self.database, nombre)(*args, **kwargs)
+
+    async def cerrar(self):
+        """Espera las operaciones en curso y libera los hilos (la Database queda abierta)"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._escritor.shutdown)
+        await loop.run_in_executor(None, self._lectores.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.cerrar()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+EXPORTACIÓN DE CITAS Y MENSAJES
+===============================
+Generadores que arman CSV, NDJSON o iCalendar fila por fila (memoria
+constante, los primeros bytes salen enseguida), con gzip opcional.
+Los usa el panel (/api/exportar/...) y también se pueden correr solos:
+
+    python exportar.py citas --formato ics --desde 2025-01-01 > agenda.ics
+    python exportar.py mensajes --formato ndjson --desde 2025-01-01 --hasta 2025-12-31 --gzip --salida 2025.ndjson.gz
+    python exportar.py citas --formato csv --estado Confirmado
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import sys
+import zlib
+
+from database import db
+
+COLUMNAS_CITAS = ['id', 'fecha', 'hora', 'cliente_nombre', 'servicio', 'estado', 'creado_en']
+COLUMNAS_MENSAJES = ['id', 'conversacion_id', 'cliente_nombre', 'es_bot', 'contenido', 'timestamp']
+
+FORMATOS = {
+    # formato: (tipos que lo admiten, mimetype, extensión)
+    'csv': (('citas', 'mensajes'), 'text/csv', 'csv'),
+    'ndjson': (('citas', 'mensajes'), 'application/x-ndjson', 'ndjson'),
+    'ics': (('citas',), 'text/calendar', 'ics'),
+}
+
+# Bytes de texto que se juntan antes de comprimir un bloque gzip
+GZIP_BLOQUE = 64 * 1024
+
+
+def exportar(tipo, formato, desde=None, hasta=None, estado=None, cliente=None, comprimir=False):
+    """
+    Valida los parámetros (ValueError si algo está mal) y retorna un
+    generador de bytes con la exportación completa.
+    """
+    if formato not in FORMATOS or tipo not in FORMATOS[formato][0]:
+        raise ValueError(f"Formato '{formato}' no disponible para {tipo}")
+    for fecha in (desde, hasta):
+        if fecha:
+            try:
+                datetime.date.fromisoformat(fecha)
+            except ValueError:
+                raise ValueError(f"Fecha inválida: {fecha} (usar YYYY-MM-DD)")
+
+    if tipo == 'citas':
+        filas = db.iterar_citas(desde, hasta, estado)
+        columnas = COLUMNAS_CITAS
+    else:
+        filas = db.iterar_mensajes(desde, hasta, cliente)
+        columnas = COLUMNAS_MENSAJES
+
+    if formato == 'csv':
+        texto = _csv(filas, columnas)
+    elif formato == 'ndjson':
+        texto = (json.dumps(fila, ensure_ascii=False) + '\n' for fila in filas)
+    else:
+        texto = _ics(filas)
+
+    bytes_ = (parte.encode('utf-8') for parte in texto)
+    return _gzip(bytes_) if comprimir else bytes_
+
+
+def nombre_archivo(tipo, formato, comprimir=False):
+    """Nombre sugerido para la descarga"""
+    nombre = f"{tipo}_{datetime.date.today().isoformat()}.{FORMATOS[formato][2]}"
+    return nombre + '.gz' if comprimir else nombre
+
+
+def _csv(filas, columnas):
+    buffer = io.StringIO()
+    buffer.write('\ufeff')  # BOM: Excel en Windows abre bien los acentos
+    escritor = csv.writer(buffer)
+    escritor.writerow(columnas)
+    for fila in filas:
+        escritor.writerow([fila.get(c) for c in columnas])
+        # Cada tanto se vacía el buffer: nunca crece más que unas filas
+        if buffer.tell() >= 8192:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _ics_texto(valor):
+    """Escapa un texto según RFC 5545"""
+    return (str(valor or '').replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _ics_linea(linea):
+    """Línea terminada en CRLF y plegada a 75 octetos (RFC 5545 3.1)"""
+    datos = linea.encode('utf-8')
+    if len(datos) <= 75:
+        return linea + '\r\n'
+    partes = []
+    while datos:
+        corte = 75 if not partes else 74
+        # No partir un carácter UTF-8 a la mitad
+        while corte < len(datos) and (datos[corte] & 0xC0) == 0x80:
+            corte -= 1
+        partes.append(datos[:corte].decode('utf-8'))
+        datos = datos[corte:]
+    return '\r\n '.join(partes) + '\r\n'
+
+
+def _ics(citas):
+    config = db.get_all_config()
+    negocio = config.get('nombre_negocio', 'Barbería')
+    intervalo = int(config.get('intervalo_turnos', 60))
+    try:
+        duraciones = {k: int(v) for k, v in json.loads(config.get('duraciones_servicio', '{}')).items()}
+    except (ValueError, TypeError, AttributeError):
+        duraciones = {}
+    sello = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+    yield ''.join(_ics_linea(l) for l in (
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Bot Barberia//Citas//ES',
+        'CALSCALE:GREGORIAN', f'X-WR-CALNAME:{_ics_texto(negocio)}',
+    ))
+    for cita in citas:
+        try:
+            inicio = datetime.datetime.strptime(f"{cita['fecha']} {cita['hora']}", '%Y-%m-%d %H:%M')
+        except (TypeError, ValueError):
+            continue  # Citas viejas con hora no parseable
+        fin = inicio + datetime.timedelta(minutes=duraciones.get(cita['servicio'], intervalo))
+        yield ''.join(_ics_linea(l) for l in (
+            'BEGIN:VEVENT',
+            f"UID:cita-{cita['id']}@barberia",
+            f'DTSTAMP:{sello}',
+            # Hora local del negocio (sin zona, igual que en la base)
+            f"DTSTART:{inicio.strftime('%Y%m%dT%H%M%S')}",
+            f"DTEND:{fin.strftime('%Y%m%dT%H%M%S')}",
+            f"SUMMARY:{_ics_texto(cita['servicio'])} - {_ics_texto(cita['cliente_nombre'])}",
+            f"STATUS:{'CONFIRMED' if cita['estado'] == 'Confirmado' else 'CANCELLED'}",
+            'END:VEVENT',
+        ))
+    yield _ics_linea('END:VCALENDAR')
+
+
+def _gzip(partes):
+    """Comprime un flujo de bytes en formato gzip, bloque por bloque"""
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = cabecera gzip
+    pendiente = []
+    tamano = 0
+    for parte in partes:
+        pendiente.append(parte)
+        tamano += len(parte)
+        if tamano >= GZIP_BLOQUE:
+            bloque = compresor.compress(b''.join(pendiente))
+            pendiente, tamano = [], 0
+            if bloque:
+                yield bloque
+    yield compresor.compress(b''.join(pendiente)) + compresor.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta citas o mensajes en CSV, NDJSON o iCalendar")
+    parser.add_argument('tipo', choices=['citas', 'mensajes'])
+    parser.add_argument('--formato', choices=sorted(FORMATOS), default='csv')
+    parser.add_argument('--desde', help="Fecha inicial YYYY-MM-DD (inclusive)")
+    parser.add_argument('--hasta', help="Fecha final YYYY-MM-DD (inclusive)")
+    parser.add_argument('--estado', help="Solo citas con este estado (Confirmado, Cancelado)")
+    parser.add_argument('--cliente', help="Solo mensajes de este cliente")
+    parser.add_argument('--gzip', action='store_true', help="Comprimir la salida")
+    parser.add_argument('--salida', help="Archivo de salida (por defecto, la salida estándar)")
+    args = parser.parse_args()
+
+    try:
+        partes = exportar(args.tipo, args.formato, args.desde, args.hasta,
+                          args.estado, args.cliente, args.gzip)
+    except ValueError as e:
+        parser.error(str(e))
+
+    salida = open(args.salida, 'wb') if args.salida else sys.stdout.buffer
+    try:
+        for parte in partes:
+            salida.write(parte)
+    finally:
+        if args.salida:
+            salida.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ Ejecuta: python iniciar.py
 Opciones:
 - python iniciar.py bot     -> Solo el bot de WhatsApp
 - python iniciar.py panel   -> Solo el panel admin
+- python iniciar.py panel produccion -> Panel con servidor de producción
 - python iniciar.py todo    -> Ambos (en diferentes terminales)
 """
 
@@ -25,6 +26,7 @@ def main():
 ║                                                            ║
 ║   python iniciar.py bot    -> Iniciar bot de WhatsApp      ║
 ║   python iniciar.py panel  -> Iniciar panel admin web      ║
+║   python iniciar.py panel produccion -> Panel (producción) ║
 ║   python iniciar.py todo   -> Iniciar ambos                ║
 ║                                                            ║
 ╚════════════════════════════════════════════════════════════╝
@@ -40,7 +42,11 @@ def main():
     elif opcion == 'panel':
         print("\n🌐 Iniciando Panel Admin...\n")
         print("Abre http://localhost:5000 en tu navegador\n")
-        os.system('python api_server.py')
+        if len(sys.argv) > 2 and sys.argv[2].lower() in ('produccion', 'producción', 'prod'):
+            # Varios hilos/procesos, sin recargador ni debugger
+            os.system('python api_server.py --produccion')
+        else:
+            os.system('python api_server.py')
         
     elif opcion == 'todo':
         print("\n🚀 Iniciando todo el sistema...\n")
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+MÉTRICAS ESTILO PROMETHEUS
+==========================
+Contadores e histogramas en memoria (por proceso) y su salida en el
+formato de texto de Prometheus:
+- api_server.py mide cada ruta y publica todo en /metrics
+- database.py mide cada método público de Database (latencia, filas,
+  errores) y la espera por el lock de escritura
+- El bot puede exponer las suyas con iniciar_servidor()
+
+Cada observación cuesta un bisect y un lock: se puede dejar encendido.
+Con varios procesos (gunicorn) cada worker guarda sus valores en un
+archivo de DIRECTORIO_PROCESOS cada pocos segundos y /metrics suma los de
+todos (ver activar_multiproceso); los de workers que terminaron se
+conservan, así los contadores nunca bajan.
+"""
+
+import bisect
+import functools
+import glob
+import inspect
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Límites de los buckets en segundos (de 0.5 ms a 10 s)
+BUCKETS_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Puerto del endpoint de métricas del bot (el panel las sirve en /metrics)
+PUERTO_BOT = 9101
+
+# Modo multiproceso: carpeta con un archivo por worker y cada cuánto se escribe
+DIRECTORIO_PROCESOS = "metricas_procesos"
+VOLCADO_SEGUNDOS = 5.0
+
+REGISTRO = []
+# Carpeta compartida entre workers (None = un solo proceso)
+_directorio = None
+_volcado_lock = threading.Lock()
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etiquetas(nombres, valores, extra=''):
+    """{a="x",b="y"} con los valores escapados"""
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return '{' + ','.join(pares) + '}' if pares else ''
+
+
+class Contador:
+    """Valor que solo sube, uno por combinación de etiquetas"""
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._valores = {}
+        self._lock = threading.Lock()
+        REGISTRO.append(self)
+
+    def inc(self, *valores, cantidad=1):
+        with self._lock:
+            self._valores[valores] = self._valores.get(valores, 0) + cantidad
+
+    def muestras(self):
+        """Copia de los valores: {etiquetas: total}"""
+        with self._lock:
+            return dict(self._valores)
+
+    def reiniciar(self):
+        with self._lock:
+            self._valores.clear()
+
+    @staticmethod
+    def sumar(a, b):
+        return a + b
+
+    def exposicion(self, muestras=None):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} counter']
+        series = sorted((self.muestras() if muestras is None else muestras).items())
+        for valores, total in series:
+            lineas.append(f'{self.nombre}{_etiquetas(self.etiquetas, valores)} {total}')
+        return lineas
+
+
+class Histograma:
+    """Distribución en buckets acumulativos (para p50/p99 con histogram_quantile)"""
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = tuple(buckets)
+        # valores de etiquetas -> [conteo por bucket..., conteo +Inf, suma]
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRO.append(self)
+
+    def observar(self, valor, *valores):
+        i = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [0] * (len(self.buckets) + 2)
+            serie[i] += 1
+            serie[-1] += valor
+
+    def muestras(self):
+        """Copia de las series: {etiquetas: [conteo por bucket..., conteo +Inf, suma]}"""
+        with self._lock:
+            return {valores: list(serie) for valores, serie in self._series.items()}
+
+    def reiniciar(self):
+        with self._lock:
+            self._series.clear()
+
+    @staticmethod
+    def sumar(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def exposicion(self, muestras=None):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} histogram']
+        series = sorted((self.muestras() if muestras is None else muestras).items())
+        for valores, serie in series:
+            acumulado = 0
+            for limite, conteo in zip(self.buckets + ('+Inf',), serie):
+                acumulado += conteo
+                le = _etiquetas(self.etiquetas, valores, f'le="{limite}"')
+                lineas.append(f'{self.nombre}_bucket{le} {acumulado}')
+            etiquetas = _etiquetas(self.etiquetas, valores)
+            lineas.append(f'{self.nombre}_sum{etiquetas} {serie[-1]:.6f}')
+            lineas.append(f'{self.nombre}_count{etiquetas} {acumulado}')
+        return lineas
+
+
+def exposicion():
+    """
+    Todas las métricas en formato de texto de Prometheus (version 0.0.4).
+    En modo multiproceso, la suma de los archivos de todos los workers.
+    """
+    if _directorio is None:
+        totales = {metrica.nombre: metrica.muestras() for metrica in REGISTRO}
+    else:
+        _volcar()  # Lo de este proceso, al día
+        totales = _leer_procesos()
+    lineas = []
+    for metrica in REGISTRO:
+        lineas.extend(metrica.exposicion(totales.get(metrica.nombre, {})))
+    return '\n'.join(lineas) + '\n'
+
+
+# ==================== VARIOS PROCESOS ====================
+
+def activar_multiproceso(directorio=DIRECTORIO_PROCESOS):
+    """
+    Llamar en el proceso principal antes de crear los workers: vacía la
+    carpeta (al reiniciar el servidor los contadores vuelven a cero, como
+    en cualquier reinicio). Cada worker llama después a iniciar_proceso().
+    """
+    global _directorio
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio, exist_ok=True)
+    _directorio = directorio
+
+
+def iniciar_proceso():
+    """En cada worker recién creado: descarta lo heredado del padre y guarda cada VOLCADO_SEGUNDOS"""
+    for metrica in REGISTRO:
+        metrica.reiniciar()
+
+    def bucle():
+        while True:
+            time.sleep(VOLCADO_SEGUNDOS)
+            try:
+                _volcar()
+            except OSError as e:
+                print(f"[METRICAS] No se pudo guardar: {e}")
+
+    threading.Thread(target=bucle, name="metricas-volcado", daemon=True).start()
+
+
+def _volcar():
+    """Escribe los valores de este proceso en su archivo (reemplazo atómico)"""
+    datos = {
+        metrica.nombre: [[list(valores), dato] for valores, dato in metrica.muestras().items()]
+        for metrica in REGISTRO
+    }
+    ruta = os.path.join(_directorio, f"{os.getpid()}.json")
+    with _volcado_lock:
+        with open(ruta + ".tmp", 'w', encoding='utf-8') as archivo:
+            json.dump(datos, archivo)
+        os.replace(ruta + ".tmp", ruta)
+
+
+def _leer_procesos():
+    """Suma por métrica y etiquetas los archivos de todos los procesos"""
+    sumas = {metrica.nombre: metrica.sumar for metrica in REGISTRO}
+    totales = {nombre: {} for nombre in sumas}
+    for ruta in glob.glob(os.path.join(_directorio, '*.json')):
+        try:
+            with open(ruta, encoding='utf-8') as archivo:
+                datos = json.load(archivo)
+        except (OSError, ValueError):
+            continue
+        for nombre, series in datos.items():
+            if nombre not in sumas:
+                continue
+            destino = totales[nombre]
+            for valores, dato in series:
+                valores = tuple(valores)
+                destino[valores] = sumas[nombre](destino[valores], dato) if valores in destino else dato
+    return totales
+
+
+# ==================== MÉTRICAS DE LA BASE DE DATOS ====================
+
+DB_LLAMADAS = Histograma('barberia_db_llamada_segundos', 'Duración de cada método de Database', ('metodo',))
+DB_FILAS = Contador('barberia_db_filas_total', 'Filas devueltas por método de Database', ('metodo',))
+DB_ERRORES = Contador('barberia_db_errores_total', 'Excepciones por método de Database', ('metodo', 'tipo'))
+DB_ESPERA_LOCK = Histograma('barberia_db_espera_lock_segundos', 'Espera hasta obtener el lock de escritura (BEGIN IMMEDIATE)')
+DB_BLOQUEOS = Contador('barberia_db_bloqueos_total', 'Errores "database is locked"')
+
+
+def _filas(resultado):
+    """Filas en un resultado: listas, o (lista, cursor) de los métodos paginados"""
+    if isinstance(resultado, list):
+        return len(resultado)
+    if isinstance(resultado, tuple) and resultado and isinstance(resultado[0], list):
+        return len(resultado[0])
+    return 0
+
+
+def _medir(nombre, metodo):
+    @functools.wraps(metodo)
+    def medido(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            resultado = metodo(*args, **kwargs)
+        except Exception as e:
+            DB_ERRORES.inc(nombre, type(e).__name__)
+            if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                DB_BLOQUEOS.inc()
+            raise
+        finally:
+            DB_LLAMADAS.observar(time.perf_counter() - inicio, nombre)
+        filas = _filas(resultado)
+        if filas:
+            DB_FILAS.inc(nombre, cantidad=filas)
+        return resultado
+    return medido
+
+
+def instrumentar(clase, excluir=()):
+    """
+    Envuelve los métodos públicos de `clase` para medirlos.
+    Los generadores y los de `excluir` (context managers, ciclo de vida) quedan igual.
+    """
+    for nombre, metodo in list(vars(clase).items()):
+        if (nombre.startswith('_') or nombre in excluir or not inspect.isfunction(metodo)
+                or inspect.isgeneratorfunction(metodo)):
+            continue
+        setattr(clase, nombre, _medir(nombre, metodo))
+    return clase
+
+
+def iniciar_servidor(puerto=PUERTO_BOT, host='127.0.0.1'):
+    """Sirve /metrics en un hilo de fondo (para procesos sin Flask, como el bot)"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Manejador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            cuerpo = exposicion().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, *args):
+            pass  # Sin una línea por scrape en la consola
+
+    try:
+        servidor = ThreadingHTTPServer((host, puerto), Manejador)
+    except OSError as e:
+        print(f"[METRICAS] No se pudo abrir el puerto {puerto}: {e}")
+        return None
+    threading.Thread(target=servidor.serve_forever, name="metricas", daemon=True).start()
+    return servidor